@@ -28,6 +28,21 @@ from send2trash import send2trash
 import datetime
 import shutil
 from rapidfuzz import fuzz, process
+from collections import deque
+import queue
+import secrets
+import math
+import sqlite3
+import fnmatch
+import mmap
+import heapq
+import zipfile
+import errno
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+try:
+    import numpy as np
+except ImportError:
+    np = None # Semantic search is unavailable without NumPy
 
 # Redefine app identification
 if platform.system() == "Windows":
@@ -47,15 +62,96 @@ PROMPT = "Return 'Prompt not loaded'." # Prompt for AI API calls, loaded from pr
 INITIAL_PROMPT = "Return 'Initial Prompt not loaded'." # Prompt for initial AI API call, loaded from initial prompt file
 WAKE_WORD = "computer" # Wake word to trigger KiloBuddy listening, loaded from wake_word file
 OS_VERSION = "auto-detect" # Operating system version for command generation
-PREVIOUS_COMMAND_OUTPUT = "" # Store the previously run USER command output for AI use
 LAST_OUTPUT = "No previous output...\n\nType a task to fulfill below." # Store the last output by the AI that was designated for the user
-USER_INTENT = "" # Store the last user command for AI use
 CONVERSATION_HISTORY = None # Store conversation history for better model context
 VERSION = "v0.0" # The version of KiloBuddy that is running
 UPDATES = "release" # The type of updates to check for, "release", "pre-release", or "none"
 MANAGE_OLLAMA = False # Whether to manage Ollama startup and shutdown
 OLLAMA_THREAD = None # Thread to track Ollama process if managed
 WINDOW_SCALING = 1.0 # Scaling for the windows to match system scaling
+HEADLESS = False # Whether KiloBuddy runs without any windows, set by batch mode
+BATCH_CONCURRENCY = 4 # Default number of commands run at the same time in batch mode
+COMMAND_NICE = 10 # Niceness for USER terminal commands on Linux (0-19), loaded from settings
+COMMAND_CPU_LIMIT = 120 # CPU seconds allowed per USER terminal command on Linux (0 for no limit), loaded from settings
+COMMAND_MEMORY_LIMIT = 0 # Memory in MB allowed per USER terminal command on Linux (0 for no limit), loaded from settings
+COMMAND_CGROUP = False # Whether to run USER terminal commands in a transient systemd scope on Linux, loaded from settings
+FILE_INDEX_ROOTS = ["~/Desktop", "~/Documents", "~/Downloads"] # Folders kept in the filename index for ds, loaded from settings, empty to disable
+FILE_INDEX_POLL = 30 # Seconds between checks of indexed folders for changes
+FILE_INDEX_MAX_CANDIDATES = 5000 # Maximum prefiltered index entries scored for one ds search
+CONTENT_INDEX_ENABLED = False # Whether text inside files under FILE_INDEX_ROOTS is indexed for sr_doc, loaded from settings
+CONTENT_INDEX_POLL = 120 # Seconds between checks of indexed files for changes
+CONTENT_INDEX_MAX_FILE = 4 * 1024 * 1024 # Files larger than this many bytes are not content indexed
+CONTENT_INDEX_MAX_TEXT = 200000 # Characters of extracted text kept per file
+CONTENT_INDEX_IDLE_CPU = 40 # System CPU percent under which the content indexer works
+CONTENT_INDEX_BATCH = 25 # Files indexed between idle checks
+CONTENT_INDEX_RESULTS = 10 # Documents returned by sr_doc
+SEMANTIC_INDEX_ENABLED = False # Whether file names under FILE_INDEX_ROOTS are embedded for sds, loaded from settings
+SEMANTIC_MODEL = "sentence-transformers/all-MiniLM-L6-v2" # Sentence model used for semantic file search, same as Machine_Classifier.py
+SEMANTIC_DIMENSIONS = 384 # Size of the vectors made by SEMANTIC_MODEL
+SEMANTIC_BATCH = 64 # File names encoded at once by the semantic indexer
+SEMANTIC_TEXT_BYTES = 1024 # Bytes of text from the start of text files added to their embedding, 0 for names only
+SEMANTIC_POLL = 300 # Seconds between checks of semantically indexed files for changes
+SEMANTIC_RESULTS = 10 # Paths returned by sds
+CONTENT_INDEX_EXTENSIONS = {".txt", ".md", ".rst", ".csv", ".tsv", ".log", ".json", ".xml", ".html", ".htm", ".yaml", ".yml", ".toml", ".ini", ".cfg", ".conf",
+                            ".tex", ".rtf", ".py", ".js", ".ts", ".java", ".c", ".h", ".cpp", ".cs", ".go", ".rs", ".sh", ".bat", ".ps1", ".sql", ".docx", ".odt"} # File types the content indexer extracts text from
+CONTENT_SEARCH_MAX_MATCHES = 40 # Maximum matching lines returned by sr_txt
+CONTENT_SEARCH_PER_FILE = 5 # Maximum matching lines taken from one file by sr_txt
+CONTENT_SEARCH_MAX_FILE = 256 * 1024 * 1024 # Files larger than this many bytes are skipped by sr_txt
+CONTENT_SEARCH_TIME_BUDGET = 5.0 # Seconds sr_txt may search before returning what it found
+CONTENT_SEARCH_OUTPUT = 2000 # Characters of sr_txt output kept for the prompt
+BULK_PREVIEW = 10 # Entry names listed in the summary of a glob or regex file operation
+BULK_CONFIRM_COUNT = 5 # Glob or regex file operations on more entries than this ask the user first
+TRANSFER_WORKERS = 8 # Files copied at the same time by mv and cp
+TRANSFER_CHUNK = 16 * 1024 * 1024 # Bytes copied per system call, cancellation is checked between chunks
+TRANSFER_BACKGROUND_BYTES = 256 * 1024 * 1024 # mv and cp larger than this many bytes run as background jobs
+TRANSFER_BACKGROUND_FILES = 5000 # mv and cp of more files than this run as background jobs
+TRANSFER_PART_SUFFIX = ".kbpart" # Suffix of partly copied files, which an interrupted mv or cp resumes from
+TRANSFER_STATE_SUFFIX = ".kbtransfer" # Suffix of the state file kept next to a folder while mv or cp copies into it
+BATCH_MAX_CALLS = 20 # Maximum tool calls in one batched USER step
+BATCH_OUTPUT_LIMIT = 300 # Characters kept from each tool output in a batched result
+READ_SAMPLE_SIZE = 8192 # Bytes checked for binary content and decoded from each end of a long read_file span
+LINE_INDEX_STRIDE = 1024 # Lines between saved offsets in the newline index used by rd_fil ranges
+LINE_INDEX_CACHE_SIZE = 32 # Maximum number of files with a cached newline index
+DISCOVER_LIMIT = 30 # Maximum results returned by ds
+SCAN_WORKERS = 8 # Threads listing folders at the same time for recursive ds searches and rd_inf summaries
+DIR_SUMMARY_TOP = 10 # Default number of largest files and folders listed by an rd_inf summary
+DIR_SUMMARY_CACHE_SIZE = 200000 # Maximum number of folder listings kept for rd_inf summaries
+DISCOVER_BATCH = 4096 # Entries scored together in one rapidfuzz batch
+DISCOVER_STABLE_BATCHES = 8 # Batches without a change to a full top result list before a recursive ds search stops early
+DISCOVER_TIME_BUDGET = 3.0 # Seconds a recursive ds search may walk before returning what it found
+PRUNED_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".cache", ".venv", "venv", ".tox", ".mypy_cache", ".pytest_cache", ".npm", ".cargo", "site-packages", ".Trash", "$RECYCLE.BIN"} # Folders skipped when indexing or walking for ds
+AUDIO_OVERFLOWS = 0 # Number of audio reads that overflowed since the last warning
+AUDIO_OVERFLOW_WARNED = 0.0 # Time of the last audio overflow warning
+MAX_CONCURRENT_INTENTS = 1 # Number of queued commands processed at the same time
+MAX_QUEUED_COMMANDS = 10 # Maximum number of commands waiting in the command queue
+PRIORITY_VOICE = 0 # Queue priority of spoken commands, lower runs first
+PRIORITY_TYPED = 1 # Queue priority of commands typed into the dashboard
+CANCEL_PHRASES = ["cancel", "cancel that", "stop", "stop that", "never mind", "nevermind", "abort"] # Spoken commands that cancel running intents instead of starting one, empty to disable
+MAX_AI_CALLS = 8 # Maximum AI round trips allowed for a single user intent
+MAX_INTENT_TIME = 180 # Maximum wall time for a single user intent in seconds
+MAX_INTENT_TOKENS = 24000 # Maximum estimated prompt and response tokens for a single user intent
+COMMAND_TIMEOUT = 45 # Duration for USER terminal commands in seconds
+OUTPUT_HEAD_LIMIT = 32 * 1024 # Bytes kept from the start of USER command output
+OUTPUT_TAIL_LIMIT = 32 * 1024 # Bytes kept from the end of USER command output
+OUTPUT_KILL_LIMIT = 8 * 1024 * 1024 # Bytes of output after which a USER command is stopped early, None to disable
+COMMAND_CACHE_TTL = 300 # Seconds a cached read-only command result stays valid
+SYSTEM_STATE_CACHE_TTL = 5 # Seconds a cached system-state command result stays valid
+READ_ONLY_TOOLS = ["rd_fil", "rd_inf", "ds", "sds", "sr_txt", "sr_doc"]
+READ_ONLY_COMMANDS = ["ls", "dir", "cat", "type", "head", "tail", "stat", "file", "du", "df", "find", "tree", "wc", "pwd", "whoami", "uname", "hostname", "free", "ps", "uptime", "lsblk", "which", "where", "grep", "sort", "uniq", "cut", "lscpu", "sw_vers", "systeminfo", "tasklist", "vm_stat", "ip", "ifconfig", "ipconfig"]
+READ_ONLY_OPTIONS = {"hostname": ["-I", "-i", "-f", "-s", "-d", "-A", "--fqdn", "--short", "--domain", "--all-ip-addresses", "--ip-address", "--all-fqdns"], "ifconfig": ["-a"]} # The only flags with which these READ_ONLY_COMMANDS are read-only
+RECURSIVE_COMMANDS = ["find", "du", "tree"] # Read-only commands that look inside subfolders, so their results are not cached
+SYSTEM_STATE_COMMANDS = ["df", "free", "ps", "uptime", "lsblk", "tasklist", "vm_stat", "ip", "ifconfig", "ipconfig"]
+MAX_BACKGROUND_JOBS = 20 # Maximum number of background jobs kept in the job table
+STEP_REFERENCE_PATTERN = re.compile(r"\$STEP\[(\d+)\]((?:\.(?:stdout|stderr|code|line\[-?\d+\]|lines\[-?\d*:-?\d*\]|field\[-?\d+\]))*)")
+CONDENSE_STOPWORDS = {"the", "and", "for", "with", "from", "into", "that", "this", "what", "which", "are", "was", "how", "all", "any", "can", "you", "your", "please", "file", "files", "folder", "output", "command", "list", "show", "find", "tell", "use", "using", "extend", "task", "ai", "user"}
+TOOL_ERROR_PREFIXES = ("Failed", "Path ", "Source path", "Search path", "Invalid", "Unknown tool", "Peek lines", "Write operation declined",
+                       "No path provided", "No source path provided", "No destination path provided", "No new name provided", "No search path provided",
+                       "No search query provided", "No description provided", "No command provided", "No job id provided", "No background job with id",
+                       "No entries in", "Search terms must be", "Semantic search is turned off", "The semantic index is", "The content index is") # Starts of tool outputs that mean the step failed, empty results like "No matches found" are not failures
+PLAN_CACHE_SIZE = 200 # Maximum number of cached plans
+PLAN_CACHE_MIN_FIXED = 3 # Minimum number of fixed words in a cached plan's command
+PLAN_CACHE_FIXED_PER_SLOT = 2 # Minimum number of fixed words per slot in a cached plan's command
+PLAN_CACHE_UNSAFE_TOOLS = ["dl", "mv", "rn", "cp", "wr_fil", "bg"] # Tools that change or remove files, whose plans are never cached
 DANGEROUS_COMMANDS = ["sudo", "rm", "del", "erase", "dd", "diskpart", "format", "shutdown", "reboot", "poweroff", "mkfs", "reg delete", "sysctl -w", "launchctl", "iptables -F", "ufw disable", "netsh"]
 
 # Vosk Speech Recognition Variables
@@ -150,6 +246,10 @@ def initialize():
         return False
     if not start_ollama():
         print("WARNING: Failed to start Ollama.\n    -Local models will not function.\nWARN 315")
+    SYSTEM_PROFILE.start()
+    FILE_INDEX.start()
+    CONTENT_INDEX.start()
+    SEMANTIC_INDEX.start()
     print("INFO: KiloBuddy Initialized.")
     return True
 
@@ -335,10 +435,130 @@ def load_manage_ollama(line):
         print(f"ERROR: Failed to parse manage_ollama setting: {e}\nERROR 113")
         return False
 
+# Load Command Niceness from settings
+def load_command_nice(line):
+    global COMMAND_NICE
+    value = line.split(":", 1)[1].strip()
+    try:
+        nice = int(value)
+        if 0 <= nice <= 19:
+            COMMAND_NICE = nice
+            print(f"INFO: Loaded Command Niceness: {COMMAND_NICE}")
+            return True
+        else:
+            print(f"ERROR: Invalid command_nice '{value}' (must be 0-19)\nERROR 154")
+            return False
+    except Exception as e:
+        print(f"ERROR: Failed to parse command_nice: {e}\nERROR 155")
+        return False
+
+# Load Command CPU Limit from settings
+def load_command_cpu_limit(line):
+    global COMMAND_CPU_LIMIT
+    value = line.split(":", 1)[1].strip()
+    try:
+        limit = int(value)
+        if limit >= 0:
+            COMMAND_CPU_LIMIT = limit
+            print(f"INFO: Loaded Command CPU Limit: {COMMAND_CPU_LIMIT} seconds")
+            return True
+        else:
+            print(f"ERROR: Invalid command_cpu_limit '{value}' (must be 0 or more seconds)\nERROR 156")
+            return False
+    except Exception as e:
+        print(f"ERROR: Failed to parse command_cpu_limit: {e}\nERROR 157")
+        return False
+
+# Load Command Memory Limit from settings
+def load_command_memory_limit(line):
+    global COMMAND_MEMORY_LIMIT
+    value = line.split(":", 1)[1].strip()
+    try:
+        limit = int(value)
+        if limit >= 0:
+            COMMAND_MEMORY_LIMIT = limit
+            print(f"INFO: Loaded Command Memory Limit: {COMMAND_MEMORY_LIMIT} MB")
+            return True
+        else:
+            print(f"ERROR: Invalid command_memory_limit '{value}' (must be 0 or more MB)\nERROR 158")
+            return False
+    except Exception as e:
+        print(f"ERROR: Failed to parse command_memory_limit: {e}\nERROR 159")
+        return False
+
+# Load Command Cgroup from settings
+def load_command_cgroup(line):
+    global COMMAND_CGROUP
+    value = line.split(":", 1)[1].strip().lower()
+    try:
+        if value in ["true", "false"]:
+            COMMAND_CGROUP = (value == "true")
+            print(f"INFO: Loaded Command Cgroup: {COMMAND_CGROUP}")
+            return True
+        else:
+            print(f"ERROR: Invalid command_cgroup value '{value}' (must be 'true' or 'false')\nERROR 160")
+            return False
+    except Exception as e:
+        print(f"ERROR: Failed to parse command_cgroup setting: {e}\nERROR 161")
+        return False
+
+# Load Content Index from settings
+def load_content_index(line):
+    global CONTENT_INDEX_ENABLED
+    value = line.split(":", 1)[1].strip().lower()
+    try:
+        if value in ["true", "false"]:
+            CONTENT_INDEX_ENABLED = (value == "true")
+            print(f"INFO: Loaded Content Index: {CONTENT_INDEX_ENABLED}")
+            return True
+        else:
+            print(f"ERROR: Invalid content_index value '{value}' (must be 'true' or 'false')\nERROR 174")
+            return False
+    except Exception as e:
+        print(f"ERROR: Failed to parse content_index setting: {e}\nERROR 175")
+        return False
+
+# Load Semantic Index from settings
+def load_semantic_index(line):
+    global SEMANTIC_INDEX_ENABLED
+    value = line.split(":", 1)[1].strip().lower()
+    try:
+        if value in ["true", "false"]:
+            SEMANTIC_INDEX_ENABLED = (value == "true")
+            print(f"INFO: Loaded Semantic Index: {SEMANTIC_INDEX_ENABLED}")
+            return True
+        else:
+            print(f"ERROR: Invalid semantic_index value '{value}' (must be 'true' or 'false')\nERROR 178")
+            return False
+    except Exception as e:
+        print(f"ERROR: Failed to parse semantic_index setting: {e}\nERROR 179")
+        return False
+
+# Load the folders kept in the filename index from settings
+def load_file_index_roots(line):
+    global FILE_INDEX_ROOTS
+    value = line.split(":", 1)[1].strip()
+    try:
+        if value.lower() == "none":
+            FILE_INDEX_ROOTS = []
+            print("INFO: Loaded File Index Roots: none")
+            return True
+        roots = [root.strip() for root in value.split(",") if root.strip()]
+        if roots:
+            FILE_INDEX_ROOTS = roots
+            print(f"INFO: Loaded File Index Roots: {', '.join(FILE_INDEX_ROOTS)}")
+            return True
+        else:
+            print(f"ERROR: Invalid file_index_roots value '{value}' (must be folders separated by commas or 'none')\nERROR 170")
+            return False
+    except Exception as e:
+        print(f"ERROR: Failed to parse file_index_roots setting: {e}\nERROR 171")
+        return False
+
 def load_settings():
     global AI_PREFERENCE, WAKE_WORD, API_TIMEOUT, GEMINI_API_KEY, CHATGPT_API_KEY, CLAUDE_API_KEY, MANAGE_OLLAMA
     success_count = 0
-    total_settings = 7
+    total_settings = 14
 
     try:
         with open(get_source_path("settings"), "r") as f:
@@ -352,6 +572,13 @@ def load_settings():
             "\n    -chatgpt_api_key: [empty]" \
             "\n    -claude_api_key: [empty]" \
             "\n    -manage_ollama: false" \
+            "\n    -command_nice: 10" \
+            "\n    -command_cpu_limit: 120" \
+            "\n    -command_memory_limit: 0" \
+            "\n    -command_cgroup: false" \
+            "\n    -file_index_roots: ~/Desktop, ~/Documents, ~/Downloads" \
+            "\n    -content_index: false" \
+            "\n    -semantic_index: false" \
             "\nWARN 313")
             return False
             
@@ -397,6 +624,41 @@ def load_settings():
                     success_count += 1
                 else:
                     print("WARNING: Failed to properly initialize manage_ollama setting.\n    -Falling back to default 'false'.\nWARN 314")
+            elif line.startswith("command_nice:"):
+                if load_command_nice(line):
+                    success_count += 1
+                else:
+                    print("WARNING: Failed to properly initialize command_nice setting.\n    -Falling back to default '10'.\nWARN 320")
+            elif line.startswith("command_cpu_limit:"):
+                if load_command_cpu_limit(line):
+                    success_count += 1
+                else:
+                    print("WARNING: Failed to properly initialize command_cpu_limit setting.\n    -Falling back to default '120'.\nWARN 321")
+            elif line.startswith("command_memory_limit:"):
+                if load_command_memory_limit(line):
+                    success_count += 1
+                else:
+                    print("WARNING: Failed to properly initialize command_memory_limit setting.\n    -Falling back to default '0'.\nWARN 322")
+            elif line.startswith("command_cgroup:"):
+                if load_command_cgroup(line):
+                    success_count += 1
+                else:
+                    print("WARNING: Failed to properly initialize command_cgroup setting.\n    -Falling back to default 'false'.\nWARN 323")
+            elif line.startswith("file_index_roots:"):
+                if load_file_index_roots(line):
+                    success_count += 1
+                else:
+                    print("WARNING: Failed to properly initialize file_index_roots setting.\n    -Falling back to default '~/Desktop, ~/Documents, ~/Downloads'.\nWARN 326")
+            elif line.startswith("content_index:"):
+                if load_content_index(line):
+                    success_count += 1
+                else:
+                    print("WARNING: Failed to properly initialize content_index setting.\n    -Falling back to default 'false'.\nWARN 327")
+            elif line.startswith("semantic_index:"):
+                if load_semantic_index(line):
+                    success_count += 1
+                else:
+                    print("WARNING: Failed to properly initialize semantic_index setting.\n    -Falling back to default 'false'.\nWARN 328")
                     
     except FileNotFoundError:
         print("ERROR: Settings file not found.\nERROR 146")
@@ -423,6 +685,13 @@ def save_settings():
             f.write(f"chatgpt_api_key: {CHATGPT_API_KEY}\n")
             f.write(f"claude_api_key: {CLAUDE_API_KEY}\n")
             f.write(f"manage_ollama: {MANAGE_OLLAMA}\n")
+            f.write(f"command_nice: {COMMAND_NICE}\n")
+            f.write(f"command_cpu_limit: {COMMAND_CPU_LIMIT}\n")
+            f.write(f"command_memory_limit: {COMMAND_MEMORY_LIMIT}\n")
+            f.write(f"command_cgroup: {str(COMMAND_CGROUP).lower()}\n")
+            f.write(f"file_index_roots: {', '.join(FILE_INDEX_ROOTS) or 'none'}\n")
+            f.write(f"content_index: {str(CONTENT_INDEX_ENABLED).lower()}\n")
+            f.write(f"semantic_index: {str(SEMANTIC_INDEX_ENABLED).lower()}\n")
         with open(get_source_path("updates"), "w") as f:
             f.write(f"{UPDATES}\n")
         print("INFO: Successfully saved settings.")
@@ -570,36 +839,43 @@ def get_source_path(filename):
     return os.path.join(base_path, filename)
 
 # Generate Text using AI
-def generate_text(input_prompt):
+# A cancelled token stops waiting on the provider and returns None without trying the next model
+def generate_text(input_prompt, cancel=None):
     ai_models = [model.strip().lower() for model in AI_PREFERENCE.split(",")]
     
     for i, model in enumerate(ai_models):
+        if cancel is not None and cancel.is_cancelled():
+            print("INFO: Text generation cancelled.")
+            return None
         print(f"INFO: Attempting to generate text using {model.upper()}...")
         
         if model == "gemini":
             if not GEMINI_API_KEY:
                 print(f"WARNING: Gemini API key not available, trying next AI model...")
                 continue
-            result = gemini_generate(input_prompt)
+            result = gemini_generate(input_prompt, cancel)
         elif model == "chatgpt":
             if not CHATGPT_API_KEY:
                 print(f"WARNING: ChatGPT API key not available, trying next AI model...")
                 continue
-            result = chatgpt_generate(input_prompt)
+            result = chatgpt_generate(input_prompt, cancel)
         elif model == "claude":
             if not CLAUDE_API_KEY:
                 print(f"WARNING: Claude API key not available, trying next AI model...")
                 continue
-            result = claude_generate(input_prompt)
+            result = claude_generate(input_prompt, cancel)
         else:
             print(f"Using local AI model: {model}")
             print(f"If no local models are installed, this means something went wrong calling the others.")
-            result = local_generate(input_prompt, model)
+            result = local_generate(input_prompt, model, cancel)
         
         # If we got a successful result, return it
         if result is not None and result.strip():
             print(f"INFO: Successfully generated text using {model.upper()}")
             return result
+        elif cancel is not None and cancel.is_cancelled():
+            print("INFO: Text generation cancelled.")
+            return None
         else:
             print(f"WARNING: {model.upper()} failed to generate text, trying next AI model...")
     
@@ -608,7 +884,7 @@ def generate_text(input_prompt):
     show_failure_notification("ERROR 127: All AI models failed to generate text.")
     return "ERROR: All AI models failed to generate text."
 
-def local_generate(input_prompt, model_name):
+def local_generate(input_prompt, model_name, cancel=None):
     result = {"text": None}
     timeout_triggered = threading.Event()
 
@@ -649,6 +925,11 @@ def local_generate(input_prompt, model_name):
     timer.start()
 
     while result["text"] is None and not timeout_triggered.is_set():
+        if cancel is not None and cancel.is_cancelled():
+            # Abandon the request, a late reply is ignored once timeout_triggered is set
+            timeout_triggered.set()
+            timer.cancel()
+            return None
         thread.join(timeout=0.1)
 
     timer.cancel()
@@ -658,7 +939,7 @@ def local_generate(input_prompt, model_name):
 
     return result["text"]
  
-def chatgpt_generate(input_prompt):
+def chatgpt_generate(input_prompt, cancel=None):
     result = {"text": None}
     timeout_triggered = threading.Event()
 
@@ -693,6 +974,11 @@ def chatgpt_generate(input_prompt):
 
     # Check for result or timeout
     while result["text"] is None and not timeout_triggered.is_set():
+        if cancel is not None and cancel.is_cancelled():
+            # Abandon the request, a late reply is ignored once timeout_triggered is set
+            timeout_triggered.set()
+            timer.cancel()
+            return None
         thread.join(timeout=0.1)
 
     timer.cancel()
@@ -703,7 +989,7 @@ def chatgpt_generate(input_prompt):
     
     return result["text"]
 
-def claude_generate(input_prompt):
+def claude_generate(input_prompt, cancel=None):
     result = {"text": None}
     timeout_triggered = threading.Event()
 
@@ -740,6 +1026,11 @@ def claude_generate(input_prompt):
 
     # Check for result or timeout
     while result["text"] is None and not timeout_triggered.is_set():
+        if cancel is not None and cancel.is_cancelled():
+            # Abandon the request, a late reply is ignored once timeout_triggered is set
+            timeout_triggered.set()
+            timer.cancel()
+            return None
         thread.join(timeout=0.1)
 
     timer.cancel()
@@ -751,7 +1042,7 @@ def claude_generate(input_prompt):
     return result["text"]
 
 # Generate Text With Gemini
-def gemini_generate(input_prompt):
+def gemini_generate(input_prompt, cancel=None):
     result = {"text": None}
     timeout_triggered = threading.Event()
 
@@ -788,6 +1079,11 @@ def gemini_generate(input_prompt):
 
     # Check for result or timeout
     while result["text"] is None and not timeout_triggered.is_set():
+        if cancel is not None and cancel.is_cancelled():
+            # Abandon the request, a late reply is ignored once timeout_triggered is set
+            timeout_triggered.set()
+            timer.cancel()
+            return None
         thread.join(timeout=0.1)
 
     timer.cancel()
@@ -798,6 +1094,15 @@ def gemini_generate(input_prompt):
     
     return result["text"]
 
+# Count audio reads that overflowed and warn at most every 30 seconds
+def note_audio_overflow():
+    global AUDIO_OVERFLOWS, AUDIO_OVERFLOW_WARNED
+    AUDIO_OVERFLOWS += 1
+    if time.time() - AUDIO_OVERFLOW_WARNED >= 30:
+        print(f"WARNING: Audio input overflowed {AUDIO_OVERFLOWS} times. Speech may be missed while the system is busy.\nWARN 324")
+        AUDIO_OVERFLOWS = 0
+        AUDIO_OVERFLOW_WARNED = time.time()
+
 # Listen for Wake Word
 def listen_for_wake_word():
     global vosk_rec, audio_stream
@@ -807,6 +1112,8 @@ def listen_for_wake_word():
     while not STOP_EVENT.is_set():
         try:
             data, overflow = audio_stream.read(4096)
+            if overflow:
+                note_audio_overflow()
             if vosk_rec.AcceptWaveform(bytes(data)):
                 result = json.loads(vosk_rec.Result())
                 text = result.get('text', '').lower()
@@ -844,6 +1151,8 @@ def listen_for_command():
 
         while time.time() - last_speech_time < timeout_duration and not STOP_EVENT.is_set():
             data, overflow = audio_stream.read(4096)
+            if overflow:
+                note_audio_overflow()
             if vosk_rec.AcceptWaveform(bytes(data)):
                 result = json.loads(vosk_rec.Result()).get('text', '')
                 if result:
@@ -876,51 +1185,105 @@ def listen_for_command():
         hide_status_indicator()
 
 # Process Command
-def process_command(command):
+# Runs on a command queue worker, returns the execution of the intent
+# Isolated commands (batch mode) keep their own history and do not publish responses to the dashboard
+def process_command(command, history=None, isolated=False, cancel_token=None):
     if not command:
         print("INFO: No command to process.")
-        return
+        return None
+
+    execution = IntentExecution(command, history, isolated, cancel_token)
+    execution.history.add_message("USER", command)
 
-    global USER_INTENT
-    USER_INTENT = command
-    CONVERSATION_HISTORY.add_message("USER", command)
+    if replay_cached_plan(execution, command):
+        execution.print_summary()
+        return execution
 
     global INITIAL_PROMPT, OS_VERSION
-    combined_prompt = f"OS: {OS_VERSION}\nDEFAULT PATH: {Path.home() / 'Desktop'}\nConversation History:\n{CONVERSATION_HISTORY.get_formatted_history()}\n{INITIAL_PROMPT}\nUser Command: {command}"
+    combined_prompt = f"OS: {OS_VERSION}\nDEFAULT PATH: {Path.home() / 'Desktop'}\n{get_system_context()}Conversation History:\n{execution.history.get_formatted_history()}\n{INITIAL_PROMPT}\nUser Command: {command}"
 
     print("INFO: Generating response...")
     show_status_indicator("Processing", "#00FF22")
-    response = generate_text(combined_prompt)
+    started = time.time()
+    response = execution_generate(execution, combined_prompt)
+    execution.record_step(0, "AI", command, execution.step_state(response), started)
+    hide_status_indicator()
     if response:
-        hide_status_indicator()
-        process_response(response)
-    else:
-        hide_status_indicator()
+        execute_intent(execution, response)
+        # Batch runs skip the plan cache so their results always reflect the model
+        if execution.ai_calls == 1 and not execution.stop_reason and not HEADLESS:
+            PLAN_CACHE.learn(command, response, execution)
+    elif not execution.stop_reason:
         print("ERROR: No response generated.\nERROR 136")
+    execution.print_summary()
+    return execution
+
+# Run a cached plan for the command without calling a model
+# Returns False when no plan matches or the replay fails, so the command goes to the model
+def replay_cached_plan(execution, command):
+    if HEADLESS:
+        return False
+    match = PLAN_CACHE.match(command)
+    if match is None:
+        return False
+    key, steps, response = match
+    print(f"INFO: Replaying cached plan with {len(steps)} steps.")
+
+    if response:
+        execution.set_last_output(response)
+        show_overlay(response)
+
+    todo_list = [(str(i + 1), step, "USER", "DO NEXT" if i == 0 else "PENDING") for i, step in enumerate(steps)]
+    process_todo_list(todo_list, execution)
+    if all(record["state"] == "DONE" for record in execution.step_records) and not execution.stop_reason:
+        return True
+
+    print("WARNING: Cached plan failed, falling back to AI generation.\nWARN 319")
+    PLAN_CACHE.forget(key)
+    return False
+
+# Runs the task loop of an intent iteratively until it finishes or exhausts its budget
+def execute_intent(execution, response):
+    while response:
+        todo_list = process_response(response, execution)
+        if not todo_list:
+            return
 
-def process_response(response):
+        ai_step = process_todo_list(todo_list, execution)
+        if ai_step is None:
+            return
+
+        reason = execution.check_budget()
+        if reason:
+            execution.stop_reason = reason
+            print(f"WARNING: Intent stopped before completion: {reason}.\nWARN 317")
+            show_overlay(f"KiloBuddy stopped this task early.\n\n{reason}.")
+            return
+
+        step_num, command, executor, status = todo_list[ai_step]
+        print(f"INFO: Requesting AI command: {command}")
+        started = time.time()
+        response = ai_call(todo_list, execution)
+        execution.record_step(step_num, executor, command, execution.step_state(response), started)
+
+def process_response(response, execution):
     if not response:
         print("ERROR: No response generated.\nERROR 136")
-        return
-    
-    global LAST_OUTPUT
+        return None
     
     todo_list = extract_todo_list(response)
     
     # Always show user output first
     user_output = extract_user_output(response)
     if user_output:
-        # Store the output in the global variable
-        LAST_OUTPUT = user_output
-        CONVERSATION_HISTORY.add_message("AI", LAST_OUTPUT)
+        execution.set_last_output(user_output)
         show_overlay(user_output)
     
     if todo_list:
         print(f"INFO: Found {len(todo_list)} todo items")
-        process_todo_list(todo_list)
-    else:
-        print("INFO: No todo list found in response.")
-    return
+        return todo_list
+    print("INFO: No todo list found in response.")
+    return None
 
 # Extract the todo list from AI response
 def extract_todo_list(response):
@@ -937,8 +1300,9 @@ def extract_user_output(response):
         return output_pattern.group(1).strip()
     return None
 
-# Interprets the todo list and decides on user or AI call
-def process_todo_list(todo_list):
+# Interprets the todo list and runs USER tasks until an AI task is reached
+# Returns the index of the AI task, or None when the list is finished
+def process_todo_list(todo_list, execution):
     # Check if there's a DO NEXT task, if not, promote the first PENDING task
     has_do_next = any(status == "DO NEXT" for _, _, _, status in todo_list)
     if not has_do_next:
@@ -951,13 +1315,42 @@ def process_todo_list(todo_list):
     for i, (step_num, command, executor, status) in enumerate(todo_list):
         if status == "DO NEXT":
             if executor == "USER":
-                user_call(command)
+                reason = execution.check_time()
+                if reason:
+                    execution.stop_reason = reason
+                    execution.record_step(step_num, executor, command, "SKIPPED", time.time())
+                    print(f"WARNING: Intent stopped before completion: {reason}.\nWARN 317")
+                    show_overlay(f"KiloBuddy stopped this task early.\n\n{reason}.")
+                    return None
+                batch = get_privileged_batch(todo_list, i, execution)
+                if len(batch) > 1:
+                    started = time.time()
+                    results = privileged_batch_call([todo_list[k][1] for k in batch], execution, [todo_list[k][0] for k in batch])
+                    for k, succeeded in zip(batch, results):
+                        execution.record_step(todo_list[k][0], "USER", todo_list[k][1], execution.step_state(succeeded), started)
+                        update_status(todo_list, k)
+                    continue
+
+                started = time.time()
+                succeeded = user_call(command, execution, step_num)
+                execution.record_step(step_num, executor, command, execution.step_state(succeeded), started)
                 update_status(todo_list, i)
                 continue
             elif executor == "AI":
-                print(f"INFO: Requesting AI command: {command}")
-                ai_call(todo_list)
-                break
+                return i
+    return None
+
+# Returns the indexes of the consecutive privileged USER steps starting at a step
+def get_privileged_batch(todo_list, start, execution):
+    if get_elevation_method() is None:
+        return [start]
+    batch = []
+    for i in range(start, len(todo_list)):
+        step_num, command, executor, status = todo_list[i]
+        if executor != "USER" or status not in ["DO NEXT", "PENDING"] or "$STEP[" in command or not is_privileged_command(command.replace("$LAST_OUTPUT", execution.last_output)):
+            break
+        batch.append(i)
+    return batch or [start]
 
 # Update the status of a task in the todo list
 def update_status(todo_list, current_step):
@@ -970,7 +1363,10 @@ def update_status(todo_list, current_step):
             todo_list[current_step + 1] = (next_step_num, next_command, next_executor, "DO NEXT")
 
 # Execute a tool command
-def execute_tool(tool_name, raw_args):
+# Tools that can run long check the cancel token of the intent
+def execute_tool(tool_name, raw_args, cancel=None):
+    if cancel is not None and cancel.is_cancelled():
+        return "Failed to execute tool command: cancelled"
     try:
         if tool_name == "cr_dir":
             return tl_create_directory(raw_args[0])
@@ -979,30 +1375,54 @@ def execute_tool(tool_name, raw_args):
             return tl_create_file(raw_args[0])
 
         elif tool_name == "dl":
-            return tl_delete_file(raw_args[0])
+            return tl_delete_file(raw_args[0], is_dry_run(raw_args, 1))
 
         elif tool_name == "rd_fil":
             path = raw_args[0]
             peek = raw_args[1] if len(raw_args) > 1 else None
             peek_lines = int(raw_args[2]) if len(raw_args) > 2 else 0
-            return tl_read_file(path, peek, peek_lines)
+            range_lines = int(raw_args[3]) if len(raw_args) > 3 else 0
+            return tl_read_file(path, peek, peek_lines, range_lines)
 
         elif tool_name == "rd_inf":
             path = raw_args[0]
             info_type = raw_args[1] if len(raw_args) > 1 else "all"
-            return tl_get_info(path, info_type)
+            top = int(raw_args[2]) if len(raw_args) > 2 and raw_args[2] else DIR_SUMMARY_TOP
+            return tl_get_info(path, info_type, top, cancel)
 
         elif tool_name == "mv":
-            return tl_move(raw_args[0], raw_args[1])
+            return tl_move(raw_args[0], raw_args[1], is_dry_run(raw_args, 2), cancel)
+
+        elif tool_name == "cp":
+            return tl_copy(raw_args[0], raw_args[1], is_dry_run(raw_args, 2), cancel)
 
         elif tool_name == "rn":
-            return tl_rename(raw_args[0], raw_args[1])
+            return tl_rename(raw_args[0], raw_args[1], is_dry_run(raw_args, 2))
 
         elif tool_name == "wr_fil":
             return tl_write_file(raw_args[0], raw_args[1], raw_args[2])
 
         elif tool_name == "ds":
-            return tl_discover(raw_args[0], raw_args[1])
+            depth = int(raw_args[2]) if len(raw_args) > 2 and raw_args[2] else None
+            exclude = raw_args[3] if len(raw_args) > 3 else None
+            return tl_discover(raw_args[0], raw_args[1], depth, exclude, cancel)
+
+        elif tool_name == "sds":
+            return tl_semantic_discover(raw_args[0], raw_args[1])
+
+        elif tool_name == "sr_txt":
+            file_filter = raw_args[2] if len(raw_args) > 2 else None
+            return tl_search_text(raw_args[0], raw_args[1], file_filter, cancel)
+
+        elif tool_name == "sr_doc":
+            return tl_search_documents(raw_args[0], raw_args[1] if len(raw_args) > 1 else None)
+
+        elif tool_name == "bg":
+            return tl_start_job(raw_args[0])
+
+        elif tool_name == "job":
+            action = raw_args[1] if len(raw_args) > 1 else "status"
+            return tl_job(raw_args[0], action, cancel)
 
         else:
             return f"Unknown tool command: {tool_name}"
@@ -1010,6 +1430,9 @@ def execute_tool(tool_name, raw_args):
     except Exception as e:
         return f"Failed to execute tool command: {e}"
 
+def is_dry_run(raw_args, index):
+    return len(raw_args) > index and raw_args[index].lower() in ["dry", "dry-run", "dry_run"]
+
 # Create directory
 def tl_create_directory(path):
     if not path:
@@ -1035,7 +1458,7 @@ def tl_create_file(path):
                 if result:
                     pass
                 else:
-                    return "Write operation declined by user because of existing content."
+                    return declined_message("Write operation", "because of existing content")
         with open(path, "w") as f:
             pass
         return "Successfully created file."
@@ -1043,9 +1466,12 @@ def tl_create_file(path):
         return f"Failed to create file: {e}"
 
 # Delete file or directory (send to trash)
-def tl_delete_file(path):
+def tl_delete_file(path, dry=False):
     if not path:
         return "No path provided for deletion."
+    selection = select_entries(path, dry)
+    if selection is not None:
+        return bulk_file_operation("trash", selection, None, None, dry)
     try:
         if not os.path.exists(path):
             return f"Path {path} does not exist."
@@ -1058,44 +1484,167 @@ def tl_delete_file(path):
 # Read or peek at file content
 # Truncates output automatically
 # Peek: top/bottom/None
-def tl_read_file(path, peek=None, peek_lines=0):
+# The range mode reads range_lines lines starting at line peek_lines (numbered from 1)
+def tl_read_file(path, peek=None, peek_lines=0, range_lines=0):
     if not path:
         return "No path provided for file reading."
     if not os.path.exists(path):
         return f"Path {path} does not exist."
     if not os.path.isfile(path):
         return f"Path {path} is not a file."
+    peek = "none" if peek is None else peek.lower()
+    if peek not in ["none", "top", "bottom", "range"]:
+        return f"Invalid peek mode {peek}. Must be 'top', 'bottom', 'range', or None."
+    if peek != "none" and peek_lines <= 0:
+        return "Peek lines must be greater than 0."
+    if peek == "range" and range_lines <= 0:
+        return "Peek lines must be greater than 0 for the range length."
     try:
-        with open(path, "r", encoding="utf-8", errors="replace") as f:
-            lines = f.readlines()
-        if peek is None:
-            full_content = "".join(lines)
-            return truncate_middle(full_content, 800)
-        peek = peek.lower()
-        if peek == "none":
-            full_content = "".join(lines)
-            return truncate_middle(full_content, 800)
-        if peek_lines <= 0:
-            return "Peek lines must be greater than 0."
-        if peek == "top":
-            selected = lines[:peek_lines]
-            text = "".join(selected)
-            return truncate_middle(text, 800)
-        elif peek == "bottom":
-            selected = lines[-peek_lines:]
-            text = "".join(selected)
-            return truncate_middle(text, 800)
-
-        return f"Invalid peek mode {peek}. Must be 'top', 'bottom', or None."
+        # The file is memory mapped and only the requested span is scanned, so memory stays bounded on huge files
+        # procfs and sysfs files report a size of 0 and some files cannot be mapped, so those are read as a stream
+        with open(path, "rb") as f:
+            mm = None
+            try:
+                if os.fstat(f.fileno()).st_size > 0:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass
+            try:
+                return read_view(path, f, f.read() if mm is None else mm, peek, peek_lines, range_lines, mm is not None)
+            finally:
+                if mm is not None:
+                    mm.close()
     except Exception as e:
         return f"Failed to read file: {e}"
 
+# Read the requested view of a file from its mapped or streamed content
+def read_view(path, f, mm, peek, peek_lines, range_lines, mapped):
+    size = len(mm)
+    if b"\0" in mm[:READ_SAMPLE_SIZE]:
+        return f"Path {path} is a binary file ({size} bytes)."
+    if peek == "top":
+        return read_span(mm, 0, find_line_end(mm, 0, peek_lines))
+    elif peek == "bottom":
+        return read_span(mm, find_last_lines_start(mm, peek_lines), size)
+    elif peek == "range":
+        return read_line_range(path, f, mm, peek_lines, range_lines, mapped)
+    return read_span(mm, 0, size)
+
+# Read a window of lines using the cached newline index of the file
+# Streamed content is indexed on each read, since its size and mtime do not tell versions apart
+def read_line_range(path, f, mm, first_line, count, mapped=True):
+    checkpoints, total = LINE_INDEX.get(path, f, mm) if mapped else LINE_INDEX.build(mm)
+    if first_line > total:
+        return f"Invalid line {first_line}. The file has {total} lines."
+    # Jump to the nearest saved offset at or before the first line, then walk the remaining lines
+    checkpoint = (first_line - 1) // LINE_INDEX_STRIDE
+    start = find_line_end(mm, checkpoints[checkpoint], first_line - 1 - checkpoint * LINE_INDEX_STRIDE)
+    end = find_line_end(mm, start, count)
+    last_line = min(first_line + count - 1, total)
+    return f"[lines {first_line}-{last_line} of {total}]\n" + read_span(mm, start, end)
+
+# Class for caching sparse newline offsets of files, keyed on path, size and mtime
+# Entry k holds the offset where line k * LINE_INDEX_STRIDE + 1 starts
+class LineIndex:
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # Returns (checkpoints, total lines) for an open file, scanning it once per version
+    def get(self, path, f, mm):
+        stat = os.fstat(f.fileno())
+        key = (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                return entry
+        entry = self.build(mm)
+        with self.lock:
+            # Drop older versions of the same file along with the least recently used files
+            for old_key in [old_key for old_key in self.entries if old_key[0] == key[0]]:
+                del self.entries[old_key]
+            self.entries[key] = entry
+            while len(self.entries) > LINE_INDEX_CACHE_SIZE:
+                self.entries.pop(next(iter(self.entries)))
+        return entry
+
+    def build(self, mm):
+        checkpoints = [0]
+        size = len(mm)
+        position = 0
+        lines = 0
+        chunk_size = 1024 * 1024
+        while position < size:
+            chunk_end = min(position + chunk_size, size)
+            newlines = mm[position:chunk_end].count(b"\n")
+            # Skip whole chunks that do not reach the next checkpoint
+            if (lines + newlines) // LINE_INDEX_STRIDE == lines // LINE_INDEX_STRIDE:
+                lines += newlines
+                position = chunk_end
+                continue
+            while position < chunk_end:
+                index = mm.find(b"\n", position, chunk_end)
+                if index == -1:
+                    position = chunk_end
+                    break
+                lines += 1
+                position = index + 1
+                if lines % LINE_INDEX_STRIDE == 0:
+                    checkpoints.append(position)
+        # A last line without a trailing newline still counts
+        if size and mm[size - 1:size] != b"\n":
+            lines += 1
+        return checkpoints, lines
+
+LINE_INDEX = LineIndex()
+
+# Returns the offset just past the newline ending the given number of lines from a start offset
+def find_line_end(mm, start, lines):
+    position = start
+    for _ in range(lines):
+        index = mm.find(b"\n", position)
+        if index == -1:
+            return len(mm)
+        position = index + 1
+    return position
+
+# Returns the offset where the last given number of lines start, searching back from the end
+def find_last_lines_start(mm, lines):
+    end = len(mm)
+    if mm[end - 1:end] == b"\n":
+        end -= 1
+    for _ in range(lines):
+        index = mm.rfind(b"\n", 0, end)
+        if index == -1:
+            return 0
+        end = index
+    return end + 1
+
+# Decode a byte span of a file, keeping only both ends of long spans like truncate_middle does
+def read_span(mm, start, end, max_length=800):
+    if end - start <= READ_SAMPLE_SIZE:
+        text = mm[start:end].decode("utf-8", errors="replace").replace("\r\n", "\n")
+        return truncate_middle(text, max_length)
+    head = mm[start:start + READ_SAMPLE_SIZE].decode("utf-8", errors="replace").replace("\r\n", "\n")
+    tail = mm[end - READ_SAMPLE_SIZE:end].decode("utf-8", errors="replace").replace("\r\n", "\n")
+    head_length = max_length // 2
+    return head[:head_length] + " [TRUNCATED] " + tail[-(max_length - head_length):]
+
 # Return file/directory information
-def tl_get_info(path, info_type="all"):
+# The summary mode walks a directory and reports its total size, extensions and largest entries
+def tl_get_info(path, info_type="all", top=DIR_SUMMARY_TOP, cancel=None):
     if not path:
         return "No path provided for file info."
     if not os.path.exists(path):
         return f"Path {path} does not exist."
+    if info_type == "summary":
+        if not os.path.isdir(path):
+            return f"Path {path} is not a directory."
+        try:
+            return summarize_directory(path, max(1, top), cancel)
+        except Exception as e:
+            return f"Failed to get file info: {e}"
     try:
         stats = os.stat(path)
 
@@ -1115,32 +1664,153 @@ def tl_get_info(path, info_type="all"):
         elif info_type == "all":
             return f"Size: {size} bytes\nCreated: {created}\nModified: {modified}\nExtension: {extension}"
         else:
-            return f"Invalid info_type {info_type}. Must be 'size', 'create', 'mod', 'ext', or 'all'."
+            return f"Invalid info_type {info_type}. Must be 'size', 'create', 'mod', 'ext', 'all', or 'summary'."
     except Exception as e:
         return f"Failed to get file info: {e}"
 
+def format_size(size):
+    for unit in ["bytes", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return f"{size} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+
+# Class for caching folder listings for rd_inf summaries
+# A folder is listed again only when its mtime changes, which happens when entries are added, removed or renamed
+# File sizes are read again on every call, since a file can grow without its folder changing
+class DirListingCache:
+    def __init__(self):
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    # Returns (files, folders) for a folder, where files are (name, size) and folders are names
+    def list(self, folder):
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+        except OSError:
+            return [], []
+        with self.lock:
+            cached = self.listings.get(folder)
+        if cached is not None and cached[0] == mtime:
+            return self.sizes(folder, cached[1]), cached[2]
+        files = []
+        folders = []
+        try:
+            with os.scandir(folder) as iterator:
+                for entry in iterator:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.name)
+                        else:
+                            files.append((entry.name, entry.stat(follow_symlinks=False).st_size))
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        with self.lock:
+            if len(self.listings) >= DIR_SUMMARY_CACHE_SIZE:
+                self.listings.clear()
+            self.listings[folder] = (mtime, [name for name, _ in files], folders)
+        return files, folders
+
+    # Returns (name, size) for the cached file names of a folder, leaving out files that are gone
+    @staticmethod
+    def sizes(folder, names):
+        files = []
+        for name in names:
+            try:
+                files.append((name, os.stat(os.path.join(folder, name), follow_symlinks=False).st_size))
+            except OSError:
+                continue
+        return files
+
+DIR_LISTINGS = DirListingCache()
+
+# Walk a directory on a thread pool and summarize sizes, file counts by extension and the largest entries
+def summarize_directory(path, top, cancel=None):
+    root = os.path.realpath(path)
+    listings = {}
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        running = {pool.submit(DIR_LISTINGS.list, root): root}
+        while running:
+            if cancel is not None and cancel.is_cancelled():
+                for future in running:
+                    future.cancel()
+                return "Failed to get file info: cancelled"
+            done, _ = wait(running, timeout=0.05, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder = running.pop(future)
+                files, folders = future.result()
+                listings[folder] = (files, folders)
+                for name in folders:
+                    child = os.path.join(folder, name)
+                    running[pool.submit(DIR_LISTINGS.list, child)] = child
+
+    # Add up folder sizes from the deepest folders towards the root
+    sizes = {}
+    extensions = {}
+    largest_files = []
+    file_count = 0
+    for folder in sorted(listings, key=lambda folder: folder.count(os.sep), reverse=True):
+        files, folders = listings[folder]
+        total = sum(size for _, size in files) + sum(sizes.get(os.path.join(folder, name), 0) for name in folders)
+        sizes[folder] = total
+        file_count += len(files)
+        for name, size in files:
+            extension = os.path.splitext(name)[1].lower() or "(none)"
+            count, ext_size = extensions.get(extension, (0, 0))
+            extensions[extension] = (count + 1, ext_size + size)
+            if len(largest_files) < top:
+                heapq.heappush(largest_files, (size, os.path.join(folder, name)))
+            elif size > largest_files[0][0]:
+                heapq.heapreplace(largest_files, (size, os.path.join(folder, name)))
+
+    files, folders = listings[root]
+    largest_folders = sorted(((sizes.get(os.path.join(root, name), 0), name) for name in folders), reverse=True)[:top]
+    by_extension = sorted(extensions.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    lines = [
+        f"Folder: {root}",
+        f"Total: {format_size(sizes[root])} in {file_count} files, {len(listings) - 1} folders",
+        "By extension: " + (", ".join(f"{ext} {format_size(size)} ({count})" for ext, (count, size) in by_extension) or "none"),
+        "Largest folders: " + (", ".join(f"{name} {format_size(size)}" for size, name in largest_folders) or "none"),
+        "Largest files: " + (", ".join(f"{os.path.relpath(file, root)} {format_size(size)}" for size, file in sorted(largest_files, reverse=True)) or "none")
+    ]
+    print(f"INFO: Summarized {len(listings)} folders in {time.time() - started:.2f}s")
+    return "\n".join(lines)
+
 # Move a file or directory
-def tl_move(path, dest):
+# Moves within a disk are renames, moves to another disk are copied by FileTransfer and can be resumed
+def tl_move(path, dest, dry=False, cancel=None):
     if not path:
         return "No source path provided for move."
     if not dest:
         return "No destination path provided for move."
+    selection = select_entries(path, dry)
+    if selection is not None:
+        return bulk_file_operation("move", selection, dest, None, dry, cancel)
     if not os.path.exists(path):
         return f"Source path {path} does not exist."
     try:
         dest_dir = os.path.dirname(dest)
         if dest_dir and not os.path.exists(dest_dir):
             os.makedirs(dest_dir, exist_ok=True)
-        shutil.move(path, dest)
-        return "Successfully moved."
+        # Like shutil.move, an existing destination folder receives the source, unless it is the target of an interrupted move
+        if os.path.isdir(dest) and not is_unfinished_transfer(path, dest):
+            dest = os.path.join(dest, os.path.basename(os.path.normpath(path)))
+        return single_transfer("move", path, dest, cancel)
     except Exception as e:
         return f"Failed to move: {e}"
 
-def tl_rename(path, new_name):
+# With a glob selector the new name may use {name} (original name without extension), {ext} and {n} (1, 2, ...)
+# With a regex selector the new name is a replacement for the matched part (eg. \\1)
+def tl_rename(path, new_name, dry=False):
     if not path:
         return "No path provided for rename."
     if not new_name:
         return "No new name provided for rename."
+    selection = select_entries(path, dry)
+    if selection is not None:
+        return bulk_file_operation("rename", selection, None, new_name, dry)
     if not os.path.exists(path):
         return f"Path {path} does not exist."
 
@@ -1152,6 +1822,215 @@ def tl_rename(path, new_name):
     except Exception as e:
         return f"Failed to rename: {e}"
 
+# Copy a file or directory
+# An interrupted copy is resumed by running it again
+def tl_copy(path, dest, dry=False, cancel=None):
+    if not path:
+        return "No source path provided for copy."
+    if not dest:
+        return "No destination path provided for copy."
+    selection = select_entries(path, dry)
+    if selection is not None:
+        return bulk_file_operation("copy", selection, dest, None, dry, cancel)
+    if not os.path.exists(path):
+        return f"Source path {path} does not exist."
+    try:
+        dest_dir = os.path.dirname(dest)
+        if dest_dir and not os.path.exists(dest_dir):
+            os.makedirs(dest_dir, exist_ok=True)
+        if os.path.isdir(dest) and not os.path.isdir(path):
+            dest = os.path.join(dest, os.path.basename(path))
+        return single_transfer("copy", path, dest, cancel)
+    except Exception as e:
+        return f"Failed to copy: {e}"
+
+# Copy or move one entry, in the background when it is large
+def single_transfer(action, path, dest, cancel=None):
+    transfer, job = start_transfer(action, [(os.path.basename(os.path.normpath(path)), path, dest)], f"{action} {path} to {dest}", cancel)
+    if job is not None:
+        return f"Started background job {job.id} to {action} {format_size(transfer.total_bytes)} in {len(transfer.files)} files. Check it with {{job: \"{job.id}\", \"status\"}}."
+    if transfer.failed:
+        return f"Failed to {action}: {next(iter(transfer.failed.values()))}"
+    return "Successfully moved." if action == "move" else "Successfully copied."
+
+# Plan a copy or move and run it, or start it as a background job when it is too large for one step
+# Returns the (transfer, job) pair, where job is None if the transfer already ran
+def start_transfer(action, pairs, description, cancel=None):
+    transfer = FileTransfer(action, pairs)
+    transfer.plan()
+    if transfer.total_bytes > TRANSFER_BACKGROUND_BYTES or len(transfer.files) > TRANSFER_BACKGROUND_FILES:
+        return transfer, JOBS.start(description, lambda job_id, command: TransferJob(job_id, command, transfer))
+    transfer.run(cancel)
+    return transfer, None
+
+# Returns whether a folder is the target of a copy or move of the source that FileTransfer started but did not finish
+def is_unfinished_transfer(source, target):
+    try:
+        with open(os.path.normpath(target) + TRANSFER_STATE_SUFFIX, "r") as f:
+            state = json.load(f)
+        return state.get("source") == os.path.realpath(source)
+    except (OSError, ValueError, AttributeError):
+        return False
+
+# Returns whether an existing target continues an earlier copy of the source instead of being a different entry
+# Folders of an unfinished transfer are merged and files with the same size and mtime are already copied
+def is_resumable_target(source, target):
+    if os.path.islink(source) or os.path.islink(target):
+        return False
+    if os.path.isdir(source) and os.path.isdir(target):
+        return is_unfinished_transfer(source, target)
+    try:
+        return os.path.isfile(source) and os.path.isfile(target) and is_same_copy(os.stat(source), os.stat(target))
+    except OSError:
+        return False
+
+# mtimes may differ by up to 2 seconds on FAT formatted drives
+def is_same_copy(source_stat, target_stat):
+    return source_stat.st_size == target_stat.st_size and abs(source_stat.st_mtime - target_stat.st_mtime) <= 2
+
+# Copy up to count bytes at offset between two open files, returns the number of bytes copied
+# Uses copy_file_range or sendfile so the data stays in the kernel, falling back to reading and writing
+# Some file systems make the kernel calls copy nothing before the end of the file, so only a read decides the end
+def copy_chunk(source_fd, target_fd, offset, count):
+    kernel = True
+    if hasattr(os, "copy_file_range"):
+        try:
+            copied = os.copy_file_range(source_fd, target_fd, count, offset, offset)
+            if copied:
+                return copied
+            kernel = False
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF]:
+                raise
+    if kernel and sys.platform.startswith("linux"):
+        try:
+            os.lseek(target_fd, offset, os.SEEK_SET)
+            copied = os.sendfile(target_fd, source_fd, offset, count)
+            if copied:
+                return copied
+        except OSError as e:
+            if e.errno not in [errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+                raise
+    os.lseek(source_fd, offset, os.SEEK_SET)
+    os.lseek(target_fd, offset, os.SEEK_SET)
+    data = memoryview(os.read(source_fd, min(count, 1024 * 1024)))
+    written = 0
+    while written < len(data):
+        written += os.write(target_fd, data[written:])
+    return written
+
+# Returns a (folder, names, regex) selection when a path ends in a glob (eg. *.pdf) or a regex (eg. re:^IMG_\\d+),
+# or when a dry run is asked for a single existing path, otherwise None so the path is used as is
+# Existing paths are always taken literally, so names containing [ or * still work
+def select_entries(path, dry=False):
+    if os.path.exists(path):
+        if not dry:
+            return None
+        folder, name = os.path.split(os.path.normpath(path))
+        return folder, [name], None
+    folder, pattern = os.path.split(path)
+    regex = None
+    if pattern.startswith("re:"):
+        try:
+            regex = re.compile(pattern[3:])
+        except re.error as e:
+            raise ValueError(f"invalid regex {pattern[3:]}: {e}")
+        matches = lambda name: regex.search(name) is not None
+    elif any(char in pattern for char in "*?["):
+        # Globs ignore case so *.pdf also selects REPORT.PDF
+        lowered = pattern.lower()
+        matches = lambda name: fnmatch.fnmatchcase(name.lower(), lowered)
+    else:
+        return None
+    if not os.path.isdir(folder or "."):
+        raise ValueError(f"folder {folder} does not exist")
+    with os.scandir(folder or ".") as iterator:
+        names = sorted(entry.name for entry in iterator if matches(entry.name))
+    return folder, names, regex
+
+# Returns the new name of the nth renamed entry
+def bulk_new_name(name, template, regex, n):
+    if regex is not None:
+        return regex.sub(template, name)
+    stem, ext = os.path.splitext(name)
+    return template.replace("{name}", stem).replace("{ext}", ext).replace("{n}", str(n))
+
+def preview_names(names):
+    shown = ", ".join(names[:BULK_PREVIEW])
+    return shown + (f" (+{len(names) - BULK_PREVIEW} more)" if len(names) > BULK_PREVIEW else "")
+
+# Move, copy, trash or rename every entry of a selection in one pass and summarize the result
+def bulk_file_operation(action, selection, dest, new_name, dry=False, cancel=None):
+    folder, names, regex = selection
+    verbs = {"move": ("move", "Moved"), "copy": ("copy", "Copied"), "trash": ("send to trash", "Sent to trash"), "rename": ("rename", "Renamed")}
+    verb, past = verbs[action]
+    if not names:
+        return f"No entries in {folder} match the selector."
+
+    plan = []
+    targets = set()
+    skipped = []
+    for n, name in enumerate(names, 1):
+        source = os.path.join(folder, name)
+        if action in ["move", "copy"]:
+            target = os.path.join(dest, name)
+        elif action == "rename":
+            target = os.path.join(folder, bulk_new_name(name, new_name, regex, n))
+        else:
+            target = None
+        if target is not None and (target in targets or (os.path.exists(target) and os.path.normcase(target) != os.path.normcase(source))):
+            # Targets left by an interrupted move or copy are continued instead of skipped
+            if not (action in ["move", "copy"] and target not in targets and is_resumable_target(source, target)):
+                skipped.append(f"{name} (target exists)")
+                continue
+        if target is not None:
+            targets.add(target)
+        plan.append((name, source, target))
+
+    if dry:
+        lines = [f"Dry run: would {verb} {len(plan)} entries" + (f" to {dest}" if dest else "") + f": {preview_names([name for name, _, _ in plan])}"]
+        if action == "rename":
+            lines.append("New names: " + preview_names([os.path.basename(target) for _, _, target in plan]))
+        if skipped:
+            lines.append(f"Would skip {len(skipped)}: {preview_names(skipped)}")
+        return "\n".join(lines)
+
+    if len(plan) > BULK_CONFIRM_COUNT:
+        confirmed = show_custom_confirm(
+            "Confirm Many Files",
+            f"Are you sure you want to {verb} {len(plan)} entries" + (f" to {dest}" if dest else "") + f"?\n\nFolder: {folder}\nEntries: {preview_names([name for name, _, _ in plan])}",
+            parent=None
+        )
+        if not confirmed:
+            return declined_message("Write operation", f"({len(plan)} entries to {verb})")
+
+    done = []
+    if action in ["move", "copy"]:
+        os.makedirs(dest, exist_ok=True)
+        transfer, job = start_transfer(action, plan, f"{action} {len(plan)} entries from {folder} to {dest}", cancel)
+        if job is not None:
+            result = f"Started background job {job.id} to {verb} {len(plan)} entries ({format_size(transfer.total_bytes)}) to {dest}. Check it with {{job: \"{job.id}\", \"status\"}}."
+            return result + (f"\nSkipped {len(skipped)}: {preview_names(skipped)}" if skipped else "")
+        done = transfer.done_names()
+        skipped.extend(f"{name} ({error})" for name, error in transfer.failed.items())
+    else:
+        for name, source, target in plan:
+            try:
+                if action == "rename":
+                    shutil.move(source, target)
+                else:
+                    send2trash(source)
+                done.append(name)
+            except Exception as e:
+                skipped.append(f"{name} ({e})")
+
+    if not done:
+        return f"Failed to {verb} any of {len(names)} entries: {preview_names(skipped)}"
+    result = f"{past} {len(done)} of {len(names)} entries" + (f" to {dest}" if dest else "") + f": {preview_names(done)}"
+    if skipped:
+        result += f"\nSkipped {len(skipped)}: {preview_names(skipped)}"
+    return result
+
 # Write to a file
 def tl_write_file(path, content, mode):
     if not path:
@@ -1168,7 +2047,7 @@ def tl_write_file(path, content, mode):
                     if result:
                         pass
                     else:
-                        return "Write operation declined by user because of existing content."
+                        return declined_message("Write operation", "because of existing content")
             with open(path, "w") as f:
                 f.write(content)
             return "Successfully wrote to file."
@@ -1182,13 +2061,29 @@ def tl_write_file(path, content, mode):
         return f"Failed to write to file: {e}"
 
 # Search for files and directories
-def tl_discover(search_path, search_query):
+# Depth counts folder levels below the search path (1 for its direct entries, 0 for no limit)
+# Exclude is a comma separated list of name patterns (eg. "*.log, build") skipped along with their contents
+# Without a depth only the direct entries are searched, as before; the filename index answers depth 0 searches of indexed folders
+def tl_discover(search_path, search_query, depth=None, exclude=None, cancel=None):
     if not search_path:
         return "No search path provided."
     if not search_query:
         return "No search query provided."
     if not os.path.exists(search_path):
         return f"Search path {search_path} does not exist."
+    if depth is not None and depth < 0:
+        return f"Invalid depth {depth}. Must be 0 (no limit) or more."
+    excludes = [pattern.strip() for pattern in (exclude or "").split(",") if pattern.strip()]
+    if depth == 0 and FILE_INDEX.covers(search_path):
+        try:
+            return discover_indexed(search_path, search_query, excludes)
+        except Exception as e:
+            print(f"ERROR: Failed to update file index: {e}\nERROR 173")
+    if depth is not None and depth != 1:
+        try:
+            return discover_walk(search_path, search_query, depth, excludes, cancel)
+        except Exception as e:
+            return f"Failed to discover files: {e}"
     try:
         entries = os.listdir(search_path)
         full_paths = [os.path.join(search_path, entry) for entry in entries]
@@ -1211,6 +2106,312 @@ def tl_discover(search_path, search_query):
     except Exception as e:
         return f"Failed to discover files: {e}"
 
+# Search the whole tree under a folder through the filename index
+# Results are paths relative to the search path, so direct entries still show as plain names
+def discover_indexed(search_path, search_query, excludes=None):
+    root = os.path.realpath(search_path)
+    min_length = discover_min_length(search_query)
+    candidates = [(os.path.relpath(path, root), name) for path, name in FILE_INDEX.candidates(search_path, search_query) if len(name) >= min_length]
+    if excludes:
+        candidates = [(path, name) for path, name in candidates if not any(is_excluded(part, excludes) for part in path.split(os.sep))]
+    if not candidates:
+        return f"No matches found with sufficient score."
+    matches = process.extract(search_query, [name for _, name in candidates], scorer=fuzz.WRatio, limit=DISCOVER_LIMIT, score_cutoff=65)
+    return format_discover_results([(candidates[idx][0], score) for _, score, idx in matches])
+
+# Shortest name a recursive ds search scores
+# WRatio rates one or two letter names as partial matches of almost any query, which would fill the results with noise
+def discover_min_length(search_query):
+    return min(len(search_query), max(3, len(search_query) // 4))
+
+# Returns the results of a ds search as relative paths, preferring shallower paths when scores tie
+def format_discover_results(results, note=""):
+    if not results:
+        return f"No matches found with sufficient score.{note}"
+    results = sorted(results, key=lambda x: (-x[1], x[0].count(os.sep), x[0]))
+    return "\n".join(f"{path} (score: {score:.0f})" for path, score in results) + note
+
+def is_excluded(name, excludes):
+    return matches_any(name, excludes)
+
+# Returns whether a name matches at least one glob pattern
+def matches_any(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+# List one folder for a recursive ds search, returns (entries, subfolders) with paths relative to the search root
+def scan_folder(root, relative, excludes):
+    entries = []
+    folders = []
+    try:
+        with os.scandir(os.path.join(root, relative) if relative else root) as iterator:
+            for entry in iterator:
+                if excludes and is_excluded(entry.name, excludes):
+                    continue
+                path = os.path.join(relative, entry.name) if relative else entry.name
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+                if is_dir and entry.name in PRUNED_DIRS:
+                    continue
+                entries.append((path, entry.name))
+                if is_dir:
+                    folders.append(path)
+    except OSError:
+        pass
+    return entries, folders
+
+# Walk a tree breadth first on a thread pool and score names in rapidfuzz batches
+# Stops once the top results stop changing, the time budget runs out, or the intent is cancelled
+def discover_walk(search_path, search_query, depth, excludes, cancel=None):
+    root = os.path.realpath(search_path)
+    deadline = time.time() + DISCOVER_TIME_BUDGET
+    top = [] # Min-heap of (score, path) holding the best DISCOVER_LIMIT results
+    batch = []
+    scanned = 0
+    stable = 0
+    stop_reason = None
+    min_length = discover_min_length(search_query)
+
+    def score_batch():
+        nonlocal stable
+        candidates = [(path, name) for path, name in batch if len(name) >= min_length]
+        batch.clear()
+        if not candidates:
+            return
+        matches = process.extract(search_query, [name for _, name in candidates], scorer=fuzz.WRatio, score_cutoff=65, limit=None)
+        changed = False
+        for _, score, i in matches:
+            path = candidates[i][0]
+            if len(top) < DISCOVER_LIMIT:
+                heapq.heappush(top, (score, path))
+                changed = True
+            elif score > top[0][0]:
+                heapq.heapreplace(top, (score, path))
+                changed = True
+        stable = 0 if changed or len(top) < DISCOVER_LIMIT else stable + 1
+
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        running = {pool.submit(scan_folder, root, "", excludes): 1}
+        while running:
+            done, _ = wait(running, timeout=0.05, return_when=FIRST_COMPLETED)
+            for future in done:
+                level = running.pop(future)
+                entries, folders = future.result()
+                batch.extend(entries)
+                scanned += len(entries)
+                if not depth or level < depth:
+                    for folder in folders:
+                        running[pool.submit(scan_folder, root, folder, excludes)] = level + 1
+            while len(batch) >= DISCOVER_BATCH:
+                pending = batch[DISCOVER_BATCH:]
+                del batch[DISCOVER_BATCH:]
+                score_batch()
+                batch.extend(pending)
+            if cancel is not None and cancel.is_cancelled():
+                stop_reason = "cancelled"
+            elif time.time() >= deadline:
+                stop_reason = "time budget reached"
+            elif stable >= DISCOVER_STABLE_BATCHES:
+                stop_reason = "results stopped changing"
+            if stop_reason:
+                for future in running:
+                    future.cancel()
+                break
+        score_batch()
+
+    note = f"\n[Stopped early after {scanned} entries: {stop_reason}]" if stop_reason and running else ""
+    return format_discover_results([(path, score) for score, path in top], note)
+
+# Find files and folders whose names (and start of text) mean something close to a description
+def tl_semantic_discover(search_path, description):
+    if not search_path:
+        return "No search path provided."
+    if not description:
+        return "No description provided."
+    if not os.path.isdir(search_path):
+        return f"Search path {search_path} is not a folder."
+    if not SEMANTIC_INDEX_ENABLED or np is None:
+        return "Semantic search is turned off. Use ds to search by name."
+    if not SEMANTIC_INDEX.covers(search_path):
+        return f"Search path {search_path} is not in the semantic index. Use ds to search by name."
+    if not SEMANTIC_INDEX.ready.is_set():
+        return "The semantic index is still being built. Use ds to search by name."
+    results = SEMANTIC_INDEX.search(description, search_path)
+    if not results:
+        return "No indexed files found under the search path."
+    return "\n".join(f"{path} ({score:.2f})" for path, score in results)
+
+# Search inside files under a folder (or in one file) for text, or for a regex given as "re:pattern"
+# Text is matched ignoring case, file_filter is a comma separated list of name globs (eg. "*.py, *.md")
+def tl_search_text(search_path, query, file_filter=None, cancel=None):
+    if not search_path:
+        return "No search path provided."
+    if not query:
+        return "No search query provided."
+    if not os.path.exists(search_path):
+        return f"Search path {search_path} does not exist."
+    try:
+        if query.startswith("re:"):
+            pattern = re.compile(query[3:].encode("utf-8"), re.MULTILINE)
+        else:
+            pattern = re.compile(re.escape(query.encode("utf-8")), re.IGNORECASE)
+    except re.error as e:
+        return f"Invalid regex {query[3:]}: {e}"
+    filters = [name.strip().lower() for name in (file_filter or "").split(",") if name.strip()]
+
+    root = os.path.realpath(search_path)
+    if os.path.isfile(root):
+        files = iter([root])
+        root = os.path.dirname(root)
+    else:
+        files = iter_search_files(root, filters)
+
+    deadline = time.time() + CONTENT_SEARCH_TIME_BUDGET
+    results = []
+    scanned = 0
+    matched_files = 0
+    stop_reason = None
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        running = set()
+        exhausted = False
+        while running or not exhausted:
+            # Keep a bounded number of files in flight so an early stop does not leave a long queue behind
+            while not exhausted and len(running) < SCAN_WORKERS * 4:
+                path = next(files, None)
+                if path is None:
+                    exhausted = True
+                else:
+                    running.add(pool.submit(search_file, path, pattern))
+            if not running:
+                break
+            done, running = wait(running, timeout=0.05, return_when=FIRST_COMPLETED)
+            for future in done:
+                scanned += 1
+                path, matches = future.result()
+                if matches:
+                    matched_files += 1
+                    results.extend((os.path.relpath(path, root), line, snippet) for line, snippet in matches)
+            if len(results) >= CONTENT_SEARCH_MAX_MATCHES:
+                stop_reason = "match limit reached"
+            elif cancel is not None and cancel.is_cancelled():
+                stop_reason = "cancelled"
+            elif time.time() >= deadline:
+                stop_reason = "time budget reached"
+            if stop_reason:
+                for future in running:
+                    future.cancel()
+                break
+
+    if not results:
+        return f"No matches found in {scanned} files." + (f" Stopped early: {stop_reason}." if stop_reason else "")
+    results.sort()
+    lines = [f"{path}:{line}: {snippet}" for path, line, snippet in results[:CONTENT_SEARCH_MAX_MATCHES]]
+    footer = f"[{len(results)} matches in {matched_files} files, {scanned} files searched" + (f", stopped early: {stop_reason}]" if stop_reason else "]")
+    output = "\n".join(lines)
+    if len(output) > CONTENT_SEARCH_OUTPUT:
+        output = output[:CONTENT_SEARCH_OUTPUT].rsplit("\n", 1)[0] + "\n[...]"
+    return output + "\n" + footer
+
+# Yields the files under a folder for sr_txt that match the filters, skipping pruned folders like ds
+def iter_search_files(root, filters):
+    for folder, folders, names in os.walk(root):
+        folders[:] = [name for name in folders if name not in PRUNED_DIRS]
+        for name in names:
+            if not filters or matches_any(name.lower(), filters):
+                yield os.path.join(folder, name)
+
+# Returns (path, [(line number, snippet)]) for the first matches of a pattern in a text file
+def search_file(path, pattern):
+    matches = []
+    try:
+        size = os.path.getsize(path)
+        if size == 0 or size > CONTENT_SEARCH_MAX_FILE:
+            return path, matches
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if b"\0" in mm[:READ_SAMPLE_SIZE]:
+                return path, matches
+            line = 1
+            counted = 0
+            for match in pattern.finditer(mm):
+                start = match.start()
+                line += mm[counted:start].count(b"\n")
+                counted = start
+                line_start = mm.rfind(b"\n", 0, start) + 1
+                line_end = mm.find(b"\n", start)
+                if line_end == -1:
+                    line_end = len(mm)
+                # Keep a window around the match on long lines
+                window_start = max(line_start, start - 60)
+                window_end = min(line_end, match.end() + 60)
+                snippet = mm[window_start:window_end].decode("utf-8", errors="replace").strip()
+                matches.append((line, snippet))
+                if len(matches) >= CONTENT_SEARCH_PER_FILE:
+                    break
+    except (OSError, ValueError):
+        pass
+    return path, matches
+
+# Find the indexed documents whose text best matches a query, optionally only under one folder
+def tl_search_documents(query, search_path=None):
+    if not query:
+        return "No search query provided."
+    if not CONTENT_INDEX_ENABLED:
+        return "The content index is turned off. Use sr_txt to search inside files."
+    if search_path and not os.path.isdir(search_path):
+        return f"Search path {search_path} is not a folder."
+    if CONTENT_INDEX.error:
+        return f"The content index is unavailable: {CONTENT_INDEX.error}. Use sr_txt to search inside files."
+    if search_path and not CONTENT_INDEX.covers(search_path):
+        return f"Search path {search_path} is not in the content index. Use sr_txt to search inside its files."
+    if not CONTENT_INDEX.ready.is_set():
+        return "The content index is still being built. Use sr_txt to search inside files."
+    results = CONTENT_INDEX.search(query, search_path)
+    if results is None:
+        return "Search terms must be at least 3 characters long."
+    if not results:
+        return "No indexed documents matched the query."
+    return "\n".join(f"{path}: {snippet}" for path, snippet in results)
+
+# Start a terminal command as a background job
+def tl_start_job(command):
+    if not command:
+        return "No command provided for background job."
+    try:
+        tokens = shlex.split(command)
+    except ValueError as e:
+        return f"Invalid command for background job: {e}"
+    if not tokens:
+        return "No command provided for background job."
+    if os.path.basename(tokens[0]).lower() in DANGEROUS_COMMANDS:
+        return "Failed to start background job: dangerous commands cannot run in the background."
+    job = JOBS.start(command)
+    return f"Started background job {job.id}. Check it with {{job: \"{job.id}\", \"status\"}}."
+
+# Check, wait for, or cancel a background job
+# Action: status/wait/cancel, use 'all' as the id to list every job
+def tl_job(job_id, action="status", cancel=None):
+    if not job_id:
+        return "No job id provided."
+    if job_id.lower() == "all":
+        return JOBS.list_text()
+    job = JOBS.get(job_id)
+    if job is None:
+        return f"No background job with id {job_id}."
+    action = action.lower()
+    if action == "status":
+        return job.status_text()
+    elif action == "wait":
+        deadline = time.time() + COMMAND_TIMEOUT
+        while not job.done.wait(timeout=0.1) and time.time() < deadline:
+            if cancel is not None and cancel.is_cancelled():
+                break
+        return job.status_text()
+    elif action == "cancel":
+        job.cancel()
+        return job.status_text()
+    return f"Invalid job action {action}. Must be 'status', 'wait', or 'cancel'."
+
 # Strip quotes and commas from a string
 def strip_quotes_commas(s):
     s = s.strip()
@@ -1221,9 +2422,16 @@ def strip_quotes_commas(s):
     return s
 
 # Parse a tool command in the format {tool: args}
+# A batch in the format [{tool: args}, {tool: args}] is returned as ("batch", [tool commands])
 def parse_tool_call(command):
     command = command.strip()
 
+    if command.startswith("[") and command.endswith("]"):
+        calls = split_tool_batch(command[1:-1])
+        if not calls:
+            return None
+        return "batch", calls
+
     if not (command.startswith("{") and command.endswith("}")):
         return None
 
@@ -1239,38 +2447,144 @@ def parse_tool_call(command):
 
     return tool_name, raw_args
 
+# Split the inside of a batch into its {tool: args} commands, or None if anything else is in it
+def split_tool_batch(text):
+    calls = []
+    depth = 0
+    quote = None
+    start = None
+    escaped = False
+    for i, char in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'" and depth:
+            quote = char
+        elif char == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                calls.append(text[start:i + 1])
+        elif depth == 0 and not (char.isspace() or char == ","):
+            return None
+    if depth or quote or not calls:
+        return None
+    if any(parse_tool_call(call) is None for call in calls):
+        return None
+    return calls
+
+# Run the tool calls of a batch and combine their outputs into one result
+# Batches of read-only tools run in parallel, anything else runs in order
+def execute_tool_batch(calls, resolve=None, cancel=None):
+    if len(calls) > BATCH_MAX_CALLS:
+        return f"Failed to execute tool batch: {len(calls)} calls is more than the limit of {BATCH_MAX_CALLS}"
+    parsed = [parse_tool_call(call) for call in calls]
+
+    def run(tool_call):
+        tool_name, raw_args = tool_call
+        if tool_name == "batch":
+            return "Invalid batch: batches cannot be nested"
+        if resolve is not None:
+            try:
+                raw_args = [resolve(arg) for arg in raw_args]
+            except ValueError as e:
+                return f"Failed to resolve step output: {e}"
+        return execute_tool(tool_name, raw_args, cancel)
+
+    if len(parsed) > 1 and all(tool_name in READ_ONLY_TOOLS for tool_name, _ in parsed):
+        with ThreadPoolExecutor(max_workers=min(len(parsed), SCAN_WORKERS)) as pool:
+            outputs = list(pool.map(run, parsed))
+    else:
+        outputs = [run(tool_call) for tool_call in parsed]
+
+    failed = sum(1 for output in outputs if is_tool_error(output))
+    lines = [f"Failed {failed} of {len(outputs)} tool calls:"] if failed else []
+    for i, ((tool_name, raw_args), output) in enumerate(zip(parsed, outputs), 1):
+        target = raw_args[0] if raw_args else ""
+        lines.append(f"[{i}] {tool_name} {target}: {truncate_middle(output, BATCH_OUTPUT_LIMIT)}")
+    return "\n".join(lines)
+
+# Returns whether a tool output reports a failure
+def is_tool_error(output):
+    return output.startswith(TOOL_ERROR_PREFIXES)
+
 # Try to execute a tool command and return its output
-def try_execute_tool(command):
+# Resolve is applied to each argument after parsing so substituted values are never re-parsed
+def try_execute_tool(command, resolve=None, cancel=None):
     parsed = parse_tool_call(command)
     if parsed is None:
         return None
 
     tool_name, raw_args = parsed
-    output = execute_tool(tool_name, raw_args)
+    if tool_name == "batch":
+        output = execute_tool_batch(raw_args, resolve, cancel)
+        print(output)
+        return output
+    if resolve is not None:
+        try:
+            raw_args = [resolve(arg) for arg in raw_args]
+        except ValueError as e:
+            output = f"Failed to resolve step output: {e}"
+            print(output)
+            return output
+    output = execute_tool(tool_name, raw_args, cancel)
     print(output)
     return output
 
 # USER Call Subprocess
-def user_call(command):
-    global PREVIOUS_COMMAND_OUTPUT, LAST_OUTPUT, OS_VERSION
+# Returns whether the command succeeded
+# $STEP[n] references are resolved from the execution and the output is kept for later steps
+def user_call(command, execution, step_num=None):
+    global OS_VERSION
     
     show_status_indicator("Executing", "#00FF22")
 
     # Replace $LAST_OUTPUT with the actual AI output
     if "$LAST_OUTPUT" in command:
-        command = command.replace("$LAST_OUTPUT", LAST_OUTPUT)
+        command = command.replace("$LAST_OUTPUT", execution.last_output)
         print(f"INFO: Substituted $LAST_OUTPUT in command")
 
-    CONVERSATION_HISTORY.add_message("LCI", command)
+    def finish(succeeded, output, stdout=None, stderr="", code=None, truncated=False):
+        hide_status_indicator()
+        execution.previous_output = output
+        execution.history.add_message("LCO", output)
+        if step_num is not None:
+            execution.store_output(step_num, output, output if stdout is None else stdout, stderr, (0 if succeeded else 1) if code is None else code, truncated)
+        return succeeded
+
+    # Replace $STEP[n] references with recorded step outputs
+    has_references = "$STEP[" in command
+    resolve = None
+    if has_references:
+        if parse_tool_call(command) is None:
+            try:
+                command = substitute_step_references(command, execution, quote_argument)
+            except ValueError as e:
+                execution.history.add_message("LCI", command)
+                return finish(False, f"Failed to resolve step output: {e}")
+        else:
+            resolve = lambda arg: substitute_step_references(arg, execution)
+        print(f"INFO: Substituted $STEP references in command")
+
+    execution.history.add_message("LCI", command)
 
-    tool_output = try_execute_tool(command)
+    cached_output = None if has_references else COMMAND_CACHE.get(command)
+    if cached_output is not None:
+        print(f"INFO: Using cached output for read-only command: {command}")
+        return finish(not is_tool_error(cached_output), cached_output)
+
+    tool_output = try_execute_tool(command, resolve, execution.cancel_token)
     if tool_output is not None:
         print(f"INFO: Successfully executed tool command: {command}")
-        hide_status_indicator()
-
-        PREVIOUS_COMMAND_OUTPUT = tool_output
-        CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-        return
+        COMMAND_CACHE.record(command, tool_output, cacheable=not has_references)
+        return finish(not is_tool_error(tool_output), tool_output)
     
     # Check for dangerous commands
     tokens = shlex.split(command)
@@ -1278,126 +2592,913 @@ def user_call(command):
     print(f"INFO: Command found: {exe}")
     print(f"INFO: Attempting command: {command}")
     if exe.lower() in DANGEROUS_COMMANDS:
+        COMMAND_CACHE.clear()
+        if HEADLESS:
+            print("WARNING: Dangerous command declined in batch mode.")
+            return finish(False, "Dangerous command declined automatically: batch mode cannot ask for administrator confirmation.")
         print("WARNING: Dangerous command detected. Prompting for administrator confirmation.")
-        
-        if OS_VERSION.startswith("linux"):
+
+        if get_elevation_method() is not None:
+            succeeded, output = run_privileged_batch([command])[0]
+            return finish(succeeded, output)
+
+        else:
+            hide_status_indicator()
+            print("WARNING: Unknown operating system. Running dangerous command without elevation.")
+    
+    print(f"INFO: Running USER command: {command}")
+    result = run_shell_command(command, COMMAND_TIMEOUT, execution.cancel_token)
+    if result.cancelled:
+        print("INFO: USER command cancelled.")
+    elif result.timed_out:
+        print(f"ERROR: USER command timed out after {COMMAND_TIMEOUT} seconds.\nERROR 150")
+    elif result.stopped_early:
+        print(f"INFO: USER command stopped early after {result.stdout_capture.bytes} bytes of output.")
+    succeeded = result.returncode == 0 and not result.timed_out and not result.stopped_early and not result.cancelled
+    output = result.summary()
+    truncated = result.stdout_capture.truncated() or result.stderr_capture.truncated()
+    COMMAND_CACHE.record(command, output, cacheable=succeeded and not has_references and not truncated)
+    return finish(succeeded, output, result.stdout, result.stderr, result.returncode, truncated)
+
+# Quote a step output so it is passed to a terminal command as a single argument
+def quote_argument(value):
+    if platform.system() == "Windows":
+        return '"' + value.replace('"', '\\"') + '"'
+    return shlex.quote(value)
+
+# Convert a 1-based (or negative from the end) line or field number to a list index
+def step_index(number):
+    number = int(number)
+    if number == 0:
+        raise ValueError("line and field numbers start at 1")
+    return number - 1 if number > 0 else number
+
+# Resolve a $STEP[n] reference and its selectors against the recorded step outputs
+def resolve_step_reference(execution, step_num, selectors):
+    record = execution.step_outputs.get(step_num)
+    if record is None:
+        raise ValueError(f"step {step_num} has no recorded output")
+    # Only the head and tail of a long output are kept, so its text would reach the next step with a gap in it
+    if record["truncated"] and not selectors.startswith(".code"):
+        raise ValueError(f"step {step_num} output was too long to keep in full, so only its .code can be referenced")
+    value = record["output"]
+    for name, arg in re.findall(r"\.(\w+)(?:\[([^\]]*)\])?", selectors):
+        if name in ["stdout", "stderr", "code"]:
+            value = str(record[name])
+        elif name == "line":
+            lines = value.splitlines()
+            index = step_index(arg)
+            value = lines[index] if -len(lines) <= index < len(lines) else ""
+        elif name == "lines":
+            start, _, end = arg.partition(":")
+            lines = value.splitlines()
+            start_index = step_index(start) if start else 0
+            end_index = (step_index(end) + 1 or None) if end else None
+            value = "\n".join(lines[start_index:end_index])
+        elif name == "field":
+            index = step_index(arg)
+            fields = [line.split() for line in value.splitlines()]
+            value = "\n".join(parts[index] for parts in fields if -len(parts) <= index < len(parts))
+    return value.rstrip("\n")
+
+# Replace every $STEP[n] reference in text, quoting each value with quote when given
+def substitute_step_references(text, execution, quote=None):
+    def replace(match):
+        value = resolve_step_reference(execution, match.group(1), match.group(2))
+        return quote(value) if quote else value
+    return STEP_REFERENCE_PATTERN.sub(replace, text)
+
+# Split a terminal command into its pipeline segments, or None if it chains, redirects or substitutes
+def split_pipeline(command):
+    if any(token in command for token in [">", ";", "&", "`", "$(", "\n"]):
+        return None
+    try:
+        segments = [shlex.split(segment) for segment in command.split("|")]
+    except ValueError:
+        return None
+    if any(not segment for segment in segments):
+        return None
+    return segments
+
+# Returns whether a USER command only inspects the system and can be served from cache
+def is_read_only_command(command):
+    parsed = parse_tool_call(command)
+    if parsed is not None:
+        if parsed[0] == "batch":
+            return all(is_read_only_command(call) for call in parsed[1])
+        return parsed[0] in READ_ONLY_TOOLS
+
+    segments = split_pipeline(command)
+    if segments is None:
+        return False
+    for tokens in segments:
+        if os.path.basename(tokens[0]).lower() not in READ_ONLY_COMMANDS or not has_read_only_arguments(tokens):
+            return False
+    return True
+
+# Returns whether the arguments of a READ_ONLY_COMMANDS command keep it from changing anything
+# Commands like ip, hostname or sort -o are read-only only in some forms
+def has_read_only_arguments(tokens):
+    name = os.path.basename(tokens[0]).lower()
+    options = [token for token in tokens[1:] if token.startswith("-")]
+    arguments = [token for token in tokens[1:] if not token.startswith("-")]
+    if name == "find":
+        return not any(token in ["-delete", "-exec", "-execdir", "-ok", "-okdir", "-fprint", "-fprintf", "-fls"] for token in tokens)
+    if name in ["sort", "tree"]:
+        # -o writes the output to a file, also inside grouped short flags like -uo
+        return not any(option.startswith("--output") or (not option.startswith("--") and "o" in option[1:]) for option in options)
+    if name == "uniq":
+        # A second file argument is written to
+        return len(arguments) <= 1
+    if name in READ_ONLY_OPTIONS:
+        # hostname NAME renames the computer and ifconfig eth0 down changes an interface
+        return all(option in READ_ONLY_OPTIONS[name] for option in options) and len(arguments) <= (1 if name == "ifconfig" else 0)
+    if name == "ip":
+        # Only "ip OBJECT" and "ip OBJECT show/list" (eg. ip addr, ip route show) are read-only
+        return len(arguments) <= 1 or arguments[1] in ["show", "list", "ls"]
+    return True
+
+# Returns whether a read-only command's cached result can be invalidated by the stamps of the paths it names
+# Recursive listings and searches change when anything deep in a folder changes, and index searches take a query instead of a path
+def is_cacheable_command(command):
+    parsed = parse_tool_call(command)
+    if parsed is not None:
+        if parsed[0] == "batch":
+            return all(is_cacheable_command(call) for call in parsed[1])
+        tool_name, args = parsed
+        if tool_name in ["sds", "sr_txt", "sr_doc"]:
+            return False
+        if tool_name == "ds":
+            return len(args) < 3 or args[2] in ["", "1"]
+        if tool_name == "rd_inf":
+            return len(args) < 2 or args[1].lower() != "summary"
+        return True
+
+    for tokens in split_pipeline(command) or []:
+        name = os.path.basename(tokens[0]).lower()
+        options = [token for token in tokens[1:] if token.startswith("-") and not token.startswith("--")]
+        if name in RECURSIVE_COMMANDS:
+            return False
+        if name == "grep" and ("--recursive" in tokens or "--dereference-recursive" in tokens or any("r" in option or "R" in option for option in options)):
+            return False
+        if name == "ls" and ("--recursive" in tokens or any("R" in option for option in options)):
+            return False
+        if name == "dir" and "/s" in [token.lower() for token in tokens]:
+            return False
+    return True
+
+# Returns whether a result was cut short by a cancel or a time budget, so running it again could give more
+def is_partial_output(output):
+    return re.search(r"[Ss]topped early[^\n]*(cancelled|time budget reached)", output) is not None
+
+# Returns the paths a read-only command touches so its cached result can be invalidated
+def get_touched_paths(command):
+    parsed = parse_tool_call(command)
+    if parsed is not None:
+        if parsed[0] == "batch":
+            return [path for call in parsed[1] for path in get_touched_paths(call)]
+        if parsed[0] == "sr_doc":
+            # The first argument is the query, the optional second one the folder
+            return [os.path.expanduser(parsed[1][1])] if len(parsed[1]) > 1 else []
+        return [os.path.expanduser(parsed[1][0])] if parsed[1] else []
+
+    paths = []
+    for tokens in split_pipeline(command) or []:
+        for token in tokens[1:]:
+            if token.startswith("-"):
+                continue
+            path = os.path.expanduser(token)
+            if os.sep in path or os.path.exists(path):
+                paths.append(path)
+    return paths
+
+# Class for caching the results of read-only USER commands
+class CommandCache:
+    def __init__(self, max_entries = 128):
+        self.entries = {}
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    # Collapse whitespace outside quotes, since spaces inside a quoted argument change what the command does
+    def normalize(self, command):
+        parts = re.findall(r'"(?:\\.|[^"\\])*"?|\'[^\']*\'?|\s+|[^\s"\']+', command.strip())
+        return "".join(" " if part.isspace() else part for part in parts)
+
+    # Returns a (mtime, size) stamp for a path, or None if it does not exist
+    def stamp(self, path):
+        try:
+            stats = os.stat(path)
+            return (stats.st_mtime_ns, stats.st_size)
+        except OSError:
+            return None
+
+    # Returns the cached output if the entry is within its TTL and no touched path changed
+    def get(self, command):
+        key = self.normalize(command)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["created"] > entry["ttl"] or any(self.stamp(path) != stamp for path, stamp in entry["stamps"].items()):
+            with self.lock:
+                self.entries.pop(key, None)
+            return None
+        return entry["output"]
+
+    # Cache a read-only result, or clear the cache after a command that may have changed something
+    def record(self, command, output, cacheable=True):
+        if not is_read_only_command(command):
+            self.clear()
+            return
+        if not cacheable or not is_cacheable_command(command) or is_partial_output(output):
+            return
+        segments = split_pipeline(command)
+        system_state = segments is not None and any(os.path.basename(tokens[0]).lower() in SYSTEM_STATE_COMMANDS for tokens in segments)
+        stamps = {path: self.stamp(path) for path in get_touched_paths(command)}
+        # Without a path to stamp nothing would notice a change before the TTL, except for the short system-state TTL
+        if not stamps and not system_state:
+            return
+        entry = {
+            "output": output,
+            "created": time.time(),
+            "ttl": SYSTEM_STATE_CACHE_TTL if system_state else COMMAND_CACHE_TTL,
+            "stamps": stamps
+        }
+        key = self.normalize(command)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.pop(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+COMMAND_CACHE = CommandCache()
+
+# Keeps a bounded head and tail of a command output stream along with line and byte counts
+class OutputCapture:
+    def __init__(self, head_limit=None, tail_limit=None):
+        self.head_limit = OUTPUT_HEAD_LIMIT if head_limit is None else head_limit
+        self.tail_limit = OUTPUT_TAIL_LIMIT if tail_limit is None else tail_limit
+        self.head = bytearray()
+        self.tail = deque()
+        self.tail_size = 0
+        self.bytes = 0
+        self.lines = 0
+        self.lock = threading.Lock()
+
+    def feed(self, data):
+        if not data:
+            return
+        with self.lock:
+            self.bytes += len(data)
+            self.lines += data.count(b"\n")
+            if len(self.head) < self.head_limit:
+                room = self.head_limit - len(self.head)
+                self.head.extend(data[:room])
+                data = data[room:]
+            if not data:
+                return
+            self.tail.append(bytes(data))
+            self.tail_size += len(data)
+            # Drop whole chunks, then trim the oldest one, once the tail exceeds its limit
+            while self.tail_size - len(self.tail[0]) >= self.tail_limit:
+                self.tail_size -= len(self.tail.popleft())
+            if self.tail_size > self.tail_limit:
+                excess = self.tail_size - self.tail_limit
+                self.tail[0] = self.tail[0][excess:]
+                self.tail_size -= excess
+
+    def truncated(self):
+        return self.bytes > len(self.head) + self.tail_size
+
+    def text(self):
+        with self.lock:
+            head = bytes(self.head).decode("utf-8", errors="replace")
+            tail = b"".join(self.tail).decode("utf-8", errors="replace")
+            if not self.truncated():
+                return head + tail
+            omitted = self.bytes - len(self.head) - self.tail_size
+            return f"{head}\n[TRUNCATED {omitted} bytes, {self.lines} lines total]\n{tail}"
+
+# Result of a USER terminal command
+class CommandResult:
+    def __init__(self, returncode, stdout_capture, stderr_capture, timed_out=False, stopped_early=False, cancelled=False):
+        self.returncode = returncode
+        self.stdout_capture = stdout_capture
+        self.stderr_capture = stderr_capture
+        self.stdout = stdout_capture.text()
+        self.stderr = stderr_capture.text()
+        self.timed_out = timed_out
+        self.stopped_early = stopped_early
+        self.cancelled = cancelled
+        self.usage = None
+
+    # Condensed output passed on to AI tasks
+    def summary(self):
+        output = self.stdout
+        if self.stderr.strip():
+            output += f"\nSTDERR:\n{self.stderr}"
+        if self.cancelled:
+            output += "\nCommand cancelled by the user."
+        elif self.timed_out:
+            output += "\nCommand timed out before finishing."
+        elif self.stopped_early:
+            output += f"\nCommand stopped early after {self.stdout_capture.bytes + self.stderr_capture.bytes} bytes of output."
+        elif self.returncode in [152, -signal.SIGXCPU if hasattr(signal, "SIGXCPU") else -24]:
+            output += f"\nCommand stopped by the CPU time limit of {COMMAND_CPU_LIMIT} seconds."
+        elif self.returncode != 0:
+            output += f"\nExit code: {self.returncode}"
+        if self.usage:
+            output += f"\nResource usage: {self.usage}"
+        return output
+
+# Returns whether a command has produced enough output to be stopped
+def output_limit_reached(stdout_capture, stderr_capture):
+    return OUTPUT_KILL_LIMIT is not None and stdout_capture.bytes + stderr_capture.bytes >= OUTPUT_KILL_LIMIT
+
+# Wrap a terminal command with the configured rlimits and optional transient cgroup on Linux
+# Background jobs skip the CPU limit since installs and copies legitimately run long
+def limit_command(command, cpu_limit=True):
+    if platform.system() != "Linux":
+        return f"eval {shlex.quote(command)}"
+    limits = []
+    if cpu_limit and COMMAND_CPU_LIMIT > 0:
+        # The soft limit sends SIGXCPU, the hard limit a few seconds later kills commands that ignore it
+        limits.append(f"ulimit -t {COMMAND_CPU_LIMIT + 5}; ulimit -S -t {COMMAND_CPU_LIMIT}")
+    if COMMAND_MEMORY_LIMIT > 0:
+        limits.append(f"ulimit -v {COMMAND_MEMORY_LIMIT * 1024}")
+    if COMMAND_CGROUP and shutil.which("systemd-run"):
+        properties = "-p CPUWeight=20 -p IOWeight=20"
+        if COMMAND_MEMORY_LIMIT > 0:
+            properties += f" -p MemoryMax={COMMAND_MEMORY_LIMIT}M"
+        limits.append(f"exec systemd-run --user --scope --quiet {properties} -- /bin/sh -c {shlex.quote(command)}")
+    else:
+        limits.append(f"eval {shlex.quote(command)}")
+    return "; ".join(limits)
+
+# Lower the CPU and IO priority of a command process so voice recognition and the UI stay responsive
+# Children inherit both, so this covers everything a command or job starts
+def limit_process(pid):
+    if platform.system() != "Linux":
+        return
+    try:
+        process = psutil.Process(pid)
+        if COMMAND_NICE > 0:
+            process.nice(COMMAND_NICE)
+        process.ionice(psutil.IOPRIO_CLASS_BE, 7)
+    except Exception as e:
+        print(f"ERROR: Failed to lower command priority: {e}\nERROR 162")
+
+# Kill a process along with any children it started
+# A command started in its own session is also killed by process group, which reaches programs it left running with &
+def kill_process_tree(process):
+    if platform.system() != "Windows":
+        try:
+            if os.getpgid(process.pid) == process.pid:
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    try:
+        parent = psutil.Process(process.pid)
+        for child in parent.children(recursive=True):
+            try:
+                child.kill()
+            except psutil.Error:
+                pass
+    except psutil.Error:
+        pass
+    try:
+        process.kill()
+    except Exception:
+        pass
+
+# Run a USER terminal command in a new shell and stream its output into bounded captures
+# Each command gets its own session, so stopping it never touches programs earlier commands started in the background
+def run_shell_command(command, timeout, cancel=None):
+    stdout_capture = OutputCapture()
+    stderr_capture = OutputCapture()
+    started = time.time()
+    process = subprocess.Popen(limit_command(command), shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               start_new_session=platform.system() != "Windows")
+    limit_process(process.pid)
+
+    limit_hit = threading.Event()
+
+    def pump(stream, capture):
+        for chunk in iter(lambda: stream.read1(65536), b""):
+            capture.feed(chunk)
+            if output_limit_reached(stdout_capture, stderr_capture) and not limit_hit.is_set():
+                limit_hit.set()
+                kill_process_tree(process)
+
+    readers = [
+        threading.Thread(target=pump, args=(process.stdout, stdout_capture), daemon=True),
+        threading.Thread(target=pump, args=(process.stderr, stderr_capture), daemon=True)
+    ]
+    for reader in readers:
+        reader.start()
+
+    deadline = started + timeout
+    timed_out = False
+    cancelled = False
+    usage = None
+    delay = 0.0005 # Short commands are noticed within a millisecond, long ones are checked every 50ms
+    while not limit_hit.is_set():
+        finished, usage = poll_process(process)
+        if finished:
+            break
+        if time.time() >= deadline:
+            timed_out = True
+            kill_process_tree(process)
+            break
+        if cancel is not None and cancel.is_cancelled():
+            cancelled = True
+            kill_process_tree(process)
+            break
+        limit_hit.wait(delay)
+        delay = min(delay * 2, 0.05)
+    process.wait()
+    # Programs left running with & keep the pipes open, so their later output is read and dropped by the daemon readers
+    join_deadline = time.time() + 1
+    for reader in readers:
+        reader.join(timeout=max(0, join_deadline - time.time()))
+    stopped_early = limit_hit.is_set()
+    result = CommandResult(process.returncode, stdout_capture, stderr_capture, timed_out=timed_out, stopped_early=stopped_early, cancelled=cancelled)
+    if usage is not None:
+        result.usage = f"{usage.ru_utime + usage.ru_stime:.2f}s CPU, {time.time() - started:.2f}s wall"
+    return result
+
+# Reap a command if it finished, returns (finished, resource usage or None)
+# wait4 reports the CPU time of the command and everything it waited for
+def poll_process(process):
+    if not hasattr(os, "wait4"):
+        return process.poll() is not None, None
+    try:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+    except ChildProcessError:
+        return process.poll() is not None, None
+    if pid == 0:
+        return False, None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return True, usage
+
+# Long-running USER command that runs detached from the task list
+class BackgroundJob:
+    def __init__(self, job_id, command):
+        self.id = job_id
+        self.command = command
+        self.started = time.time()
+        self.finished = None
+        self.cancelled = False
+        self.stdout_capture = OutputCapture()
+        self.stderr_capture = OutputCapture()
+        self.done = threading.Event()
+        self.process = subprocess.Popen(limit_command(command, cpu_limit=False), shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        limit_process(self.process.pid)
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def watch(self):
+        def pump(stream, capture):
+            for chunk in iter(lambda: stream.read1(65536), b""):
+                capture.feed(chunk)
+
+        readers = [
+            threading.Thread(target=pump, args=(self.process.stdout, self.stdout_capture), daemon=True),
+            threading.Thread(target=pump, args=(self.process.stderr, self.stderr_capture), daemon=True)
+        ]
+        for reader in readers:
+            reader.start()
+        self.process.wait()
+        for reader in readers:
+            reader.join(timeout=1)
+        self.finished = time.time()
+        self.done.set()
+        JOBS.on_finished(self)
+
+    def cancel(self):
+        if not self.done.is_set():
+            self.cancelled = True
+            kill_process_tree(self.process)
+            self.done.wait(timeout=2)
+
+    # Last line of output, used as progress while the job runs
+    def latest_line(self):
+        captures = [self.stdout_capture, self.stderr_capture]
+        if self.done.is_set() and self.process.returncode != 0:
+            captures.reverse()
+        for capture in captures:
+            lines = [line for line in capture.text().replace("\r", "\n").split("\n") if line.strip()]
+            if lines:
+                return lines[-1].strip()
+        return ""
+
+    def state(self):
+        if not self.done.is_set():
+            return "running"
+        if self.cancelled:
+            return "cancelled"
+        return "finished" if self.process.returncode == 0 else f"failed (exit code {self.process.returncode})"
+
+    def status_text(self):
+        elapsed = (self.finished or time.time()) - self.started
+        text = f"Job {self.id} {self.state()} after {elapsed:.0f}s: {self.command}"
+        if not self.done.is_set():
+            latest = self.latest_line()
+            return f"{text}\nProgress: {latest}" if latest else text
+        result = CommandResult(self.process.returncode, self.stdout_capture, self.stderr_capture)
+        return f"{text}\n{result.summary()}"
+
+# Class for copying or moving entries file by file with a pool of workers
+# Files are written to a .kbpart file first, so an interrupted transfer resumes where it stopped when run again
+class FileTransfer:
+    def __init__(self, action, pairs):
+        self.action = action # "copy" or "move"
+        self.pairs = pairs # (name, source, target) of each entry
+        self.folders = [] # (name, source, target) of folders to create
+        self.files = [] # (name, source, target, size) of files to copy
+        self.links = [] # (name, source, target) of symlinks to recreate
+        self.renamed = set() # Names of entries moved with a single rename
+        self.failed = {} # Name of an entry to the first error it had
+        self.total_bytes = 0
+        self.copied_bytes = 0
+        self.copied_files = 0
+        self.started = None
+        self.lock = threading.Lock()
+
+    # Rename moves that stay on one disk and list the folders, files and links to copy for the rest
+    def plan(self):
+        for name, source, target in self.pairs:
+            real_source = os.path.realpath(source)
+            if os.path.isdir(source) and FileIndex.contains(real_source, os.path.realpath(target)):
+                self.failed[name] = "cannot put a folder inside itself"
+                continue
+            if os.path.isdir(source) and os.path.lexists(target) and not is_resumable_target(source, target):
+                self.failed[name] = f"destination {target} already exists"
+                continue
+            if self.action == "move" and not os.path.lexists(target):
+                try:
+                    os.rename(source, target)
+                    self.renamed.add(name)
+                    continue
+                except OSError:
+                    pass # On another disk, so it is copied and then removed
+            stack = [(source, target)]
+            while stack:
+                source_path, target_path = stack.pop()
+                try:
+                    if os.path.islink(source_path):
+                        self.links.append((name, source_path, target_path))
+                    elif os.path.isdir(source_path):
+                        self.folders.append((name, source_path, target_path))
+                        with os.scandir(source_path) as iterator:
+                            stack.extend((entry.path, os.path.join(target_path, entry.name)) for entry in iterator)
+                    else:
+                        size = os.stat(source_path).st_size
+                        self.files.append((name, source_path, target_path, size))
+                        self.total_bytes += size
+                except OSError as e:
+                    self.failed.setdefault(name, str(e))
+
+    def run(self, cancel=None):
+        self.started = time.time()
+        # A state file next to each copied folder lets a later mv or cp tell its unfinished target from a folder that was already there
+        for name, source, target in self.pairs:
+            if name not in self.renamed and name not in self.failed and os.path.isdir(source):
+                try:
+                    with open(os.path.normpath(target) + TRANSFER_STATE_SUFFIX, "w") as f:
+                        json.dump({"action": self.action, "source": os.path.realpath(source)}, f)
+                except OSError as e:
+                    self.failed[name] = str(e)
+        for name, source, target in self.folders:
             try:
-                print("INFO: Using pkexec for administrator authentication...")
-                
-                actual_user = os.environ.get('USER') or os.environ.get('USERNAME')
-                if actual_user and actual_user != 'root':
-                    user_home = f"/home/{actual_user}"
-                    expanded_command = command.replace("~/", f"{user_home}/")
-                else:
-                    expanded_command = command
-                
-                result = subprocess.run(["pkexec", "bash", "-c", expanded_command], capture_output=True, text=True, timeout=45)
-                if result.returncode == 0:
-                    hide_status_indicator()
-                    print("INFO: Dangerous command executed successfully with administrator privileges.")
-                    PREVIOUS_COMMAND_OUTPUT = result.stdout
-                    CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                else:
-                    hide_status_indicator()
-                    print(f"ERROR: Dangerous command failed or was cancelled. {result.stderr}\nERROR 142")
-                    PREVIOUS_COMMAND_OUTPUT = f"Command cancelled or failed: {result.stderr}"
-                    CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-            except subprocess.TimeoutExpired:
-                hide_status_indicator()
-                print("ERROR: Administrator authentication timed out.")
-                PREVIOUS_COMMAND_OUTPUT = "Command timed out during authentication"
-                CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-            except Exception as e:
-                hide_status_indicator()
-                print(f"ERROR: Failed to prompt for administrator confirmation: {e}\nERROR 141")
-                PREVIOUS_COMMAND_OUTPUT = "Failed to authenticate as administrator"
-                CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-        
-        elif OS_VERSION.startswith("darwin"):
+                os.makedirs(target, exist_ok=True)
+            except OSError as e:
+                self.failed.setdefault(name, str(e))
+        for name, source, target in self.links:
             try:
-                print("INFO: Using sudo for administrator authentication...")
-                
-                actual_user = os.environ.get('USER') or os.environ.get('USERNAME')
-                if actual_user and actual_user != 'root':
-                    user_home = f"/Users/{actual_user}"
-                    expanded_command = command.replace("~/", f"{user_home}/")
-                else:
-                    expanded_command = command
-                
-                result = subprocess.run(["sudo", "bash", "-c", expanded_command], capture_output=True, text=True, timeout=45)
-                if result.returncode == 0:
-                    hide_status_indicator()
-                    print("INFO: Dangerous command executed successfully with administrator privileges.")
-                    PREVIOUS_COMMAND_OUTPUT = result.stdout
-                    CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                else:
-                    hide_status_indicator()
-                    print(f"ERROR: Dangerous command failed or was cancelled. {result.stderr}\nERROR 142")
-                    PREVIOUS_COMMAND_OUTPUT = f"Command cancelled or failed: {result.stderr}"
-                    CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-            except subprocess.TimeoutExpired:
-                hide_status_indicator()
-                print("ERROR: Administrator authentication timed out.")
-                PREVIOUS_COMMAND_OUTPUT = "Command timed out during authentication"
-                CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-            except Exception as e:
-                hide_status_indicator()
-                print(f"ERROR: Failed to prompt for administrator confirmation: {e}")
-                PREVIOUS_COMMAND_OUTPUT = "Failed to authenticate as administrator"
-                CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-        
-        elif OS_VERSION.startswith("windows"):
+                if not os.path.lexists(target):
+                    os.symlink(os.readlink(source), target)
+            except OSError as e:
+                self.failed.setdefault(name, str(e))
+
+        with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as pool:
+            futures = {pool.submit(self.copy_file, source, target, size, cancel): name
+                       for name, source, target, size in self.files if name not in self.failed}
+            for future, name in futures.items():
+                try:
+                    if not future.result():
+                        self.failed.setdefault(name, "cancelled")
+                except Exception as e:
+                    self.failed.setdefault(name, str(e))
+
+        # Folder times are copied last, since creating their files changed them
+        for name, source, target in reversed(self.folders):
             try:
-                print("INFO: Using PowerShell with -Verb RunAs for administrator authentication...")
-                
-                actual_user = os.environ.get('USERNAME')
-                if actual_user:
-                    user_profile = f"C:\\Users\\{actual_user}"
-                    expanded_command = command.replace("%USERPROFILE%", user_profile)
-                else:
-                    expanded_command = command
-                
-                ps_command = f'Start-Process -FilePath "cmd" -ArgumentList "/c {expanded_command}" -Verb RunAs -Wait -PassThru'
-                result = subprocess.run(["powershell", "-Command", ps_command], capture_output=True, text=True, timeout=45)
-                if result.returncode == 0:
-                    hide_status_indicator()
-                    print("INFO: Dangerous command executed successfully with administrator privileges.")
-                    PREVIOUS_COMMAND_OUTPUT = result.stdout
-                    CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                else:
-                    hide_status_indicator()
-                    print(f"ERROR: Dangerous command failed or was cancelled. {result.stderr}\nERROR 142")
-                    PREVIOUS_COMMAND_OUTPUT = f"Command cancelled or failed: {result.stderr}"
-                    CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-            except subprocess.TimeoutExpired:
-                hide_status_indicator()
-                print("ERROR: Administrator authentication timed out.")
-                PREVIOUS_COMMAND_OUTPUT = "Command timed out during authentication"
-                CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-            except Exception as e:
-                hide_status_indicator()
-                print(f"ERROR: Failed to prompt for administrator confirmation: {e}")
-                PREVIOUS_COMMAND_OUTPUT = "Failed to authenticate as administrator"
-                CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
-                return
-        
+                shutil.copystat(source, target)
+            except OSError:
+                pass
+        if self.action == "move":
+            for name, source, target in self.pairs:
+                if name in self.renamed or name in self.failed:
+                    continue
+                try:
+                    if os.path.isdir(source) and not os.path.islink(source):
+                        shutil.rmtree(source)
+                    else:
+                        os.remove(source)
+                except OSError as e:
+                    self.failed[name] = f"copied but not removed: {e}"
+        for name, source, target in self.pairs:
+            if name not in self.renamed and name not in self.failed:
+                try:
+                    os.remove(os.path.normpath(target) + TRANSFER_STATE_SUFFIX)
+                except OSError:
+                    pass
+        print(f"INFO: {'Moved' if self.action == 'move' else 'Copied'} {format_size(self.copied_bytes)} in {self.copied_files} files in {time.time() - self.started:.2f}s")
+
+    # Copy one file through its .kbpart file, returns False if cancelled
+    def copy_file(self, source, target, size, cancel):
+        if cancel is not None and cancel.is_cancelled():
+            return False
+        source_stat = os.stat(source)
+        try:
+            if is_same_copy(source_stat, os.stat(target)):
+                self.add_progress(size, 1)
+                return True
+        except OSError:
+            pass
+        part = target + TRANSFER_PART_SUFFIX
+        offset = 0
+        try:
+            part_stat = os.stat(part)
+            # A part written before the source last changed holds old data
+            if part_stat.st_size <= size and part_stat.st_mtime >= source_stat.st_mtime:
+                offset = part_stat.st_size
+        except OSError:
+            pass
+        self.add_progress(offset, 0)
+        with open(source, "rb") as source_file, open(part, "r+b" if offset else "wb") as target_file:
+            while offset < size:
+                if cancel is not None and cancel.is_cancelled():
+                    return False
+                copied = copy_chunk(source_file.fileno(), target_file.fileno(), offset, min(TRANSFER_CHUNK, size - offset))
+                if copied == 0:
+                    break
+                offset += copied
+                self.add_progress(copied, 0)
+            if offset != size:
+                # The part file is kept for a retry and the source of a move is not removed
+                raise OSError(f"{source} got shorter while copying ({offset} of {size} bytes)")
+            target_file.truncate(offset)
+        shutil.copystat(source, part)
+        os.replace(part, target)
+        self.add_progress(0, 1)
+        return True
+
+    def add_progress(self, size, files):
+        with self.lock:
+            self.copied_bytes += size
+            self.copied_files += files
+
+    def progress_text(self):
+        with self.lock:
+            copied_bytes, copied_files = self.copied_bytes, self.copied_files
+        elapsed = time.time() - self.started if self.started else 0
+        rate = f", {format_size(int(copied_bytes / elapsed))}/s" if elapsed > 1 else ""
+        return f"{format_size(copied_bytes)} of {format_size(self.total_bytes)}, {copied_files} of {len(self.files)} files{rate}"
+
+    # Names of the entries that were fully copied or moved
+    def done_names(self):
+        return [name for name, source, target in self.pairs if name not in self.failed]
+
+# Class for a copy or move running in the background, with the same interface as BackgroundJob
+class TransferJob:
+    def __init__(self, job_id, command, transfer):
+        self.id = job_id
+        self.command = command
+        self.transfer = transfer
+        self.started = time.time()
+        self.finished = None
+        self.cancelled = False
+        self.cancel_token = CancelToken()
+        self.done = threading.Event()
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def watch(self):
+        try:
+            self.transfer.run(self.cancel_token)
+        except Exception as e:
+            self.transfer.failed.setdefault("transfer", str(e))
+        self.finished = time.time()
+        self.done.set()
+        JOBS.on_finished(self)
+
+    def cancel(self):
+        if not self.done.is_set():
+            self.cancelled = True
+            self.cancel_token.cancel("Background job cancelled")
+            self.done.wait(timeout=2)
+
+    def latest_line(self):
+        if not self.done.is_set() or not self.transfer.failed:
+            return self.transfer.progress_text()
+        return "Failed: " + preview_names([f"{name} ({error})" for name, error in self.transfer.failed.items()])
+
+    def state(self):
+        if not self.done.is_set():
+            return "running"
+        if self.cancelled:
+            return "cancelled"
+        return f"failed ({len(self.transfer.failed)} entries)" if self.transfer.failed else "finished"
+
+    def status_text(self):
+        elapsed = (self.finished or time.time()) - self.started
+        text = f"Job {self.id} {self.state()} after {elapsed:.0f}s: {self.command}"
+        if not self.done.is_set():
+            return f"{text}\nProgress: {self.latest_line()}"
+        done = self.transfer.done_names()
+        text += f"\nDone: {len(done)} of {len(self.transfer.pairs)} entries, {self.transfer.progress_text()}"
+        if self.transfer.failed:
+            text += f"\n{self.latest_line()}\nRun the same {self.transfer.action} again to resume."
+        return text
+
+# Class for managing the table of background jobs
+class JobManager:
+    def __init__(self):
+        self.jobs = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    # factory builds the job from its id and command, eg. a TransferJob instead of a terminal command
+    # The job is built outside the lock, since starting its process can be slow
+    def start(self, command, factory=None):
+        with self.lock:
+            job_id = str(self.next_id)
+            self.next_id += 1
+        job = (factory or BackgroundJob)(job_id, command)
+        with self.lock:
+            self.jobs[job_id] = job
+            # Forget the oldest finished jobs once the table is full
+            for old_id in [key for key, value in self.jobs.items() if value.done.is_set()]:
+                if len(self.jobs) <= MAX_BACKGROUND_JOBS:
+                    break
+                del self.jobs[old_id]
+        print(f"INFO: Started background job {job_id}: {command}")
+        show_overlay(f"Started background job {job_id}:\n{command}")
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(str(job_id).strip())
+
+    def list_text(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        if not jobs:
+            return "No background jobs."
+        return "\n".join(f"Job {job.id} {job.state()}: {job.command}" for job in jobs)
+
+    def on_finished(self, job):
+        COMMAND_CACHE.clear()
+        print(f"INFO: Background job {job.id} {job.state()}: {job.command}")
+        CONVERSATION_HISTORY.add_message("JOB", f"{job.id} {job.state()}: {job.command}")
+        if not job.cancelled:
+            latest = job.latest_line()
+            show_overlay(f"Background job {job.id} {job.state()}:\n{job.command}" + (f"\n\n{latest}" if latest else ""))
+
+    def cancel_all(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancel()
+
+JOBS = JobManager()
+
+# Returns whether a USER terminal command needs administrator privileges
+def is_privileged_command(command):
+    if parse_tool_call(command) is not None:
+        return False
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        return False
+    return bool(tokens) and os.path.basename(tokens[0]).lower() in DANGEROUS_COMMANDS
+
+# Returns the elevation method for the operating system, or None if it is not supported
+def get_elevation_method():
+    if OS_VERSION.startswith("linux"):
+        return "pkexec"
+    elif OS_VERSION.startswith("darwin") or OS_VERSION.startswith("macos"):
+        return "sudo"
+    elif OS_VERSION.startswith("windows"):
+        return "runas"
+    return None
+
+# Expand the user's home in a command, since it will run as the administrator
+def expand_user_home(command, method):
+    if method == "runas":
+        actual_user = os.environ.get('USERNAME')
+        if actual_user:
+            return command.replace("%USERPROFILE%", f"C:\\Users\\{actual_user}")
+        return command
+
+    actual_user = os.environ.get('USER') or os.environ.get('USERNAME')
+    if actual_user and actual_user != 'root':
+        user_home = f"/home/{actual_user}" if method == "pkexec" else f"/Users/{actual_user}"
+        return command.replace("~/", f"{user_home}/")
+    return command
+
+# Run privileged commands in order in one elevated session, so consecutive steps need one authentication
+# Returns a (succeeded, output) pair for each command
+def run_privileged_batch(commands):
+    if HEADLESS:
+        print(f"WARNING: {len(commands)} privileged command(s) declined in batch mode.")
+        return [(False, "Dangerous command declined automatically: batch mode cannot ask for administrator confirmation.")] * len(commands)
+    method = get_elevation_method()
+    expanded = [expand_user_home(command, method) for command in commands]
+    # The one authentication prompt cannot show the commands, so every command is listed for the user first
+    listing = "\n".join(f"{i}. {command}" for i, command in enumerate(expanded, 1))
+    confirmed = show_custom_confirm(
+        "Run As Administrator",
+        f"Are you sure you want to run {'this command' if len(expanded) == 1 else f'these {len(expanded)} commands'} with administrator privileges?\n\n{listing}",
+        parent=None
+    )
+    if not confirmed:
+        print("INFO: Privileged commands declined by user.")
+        return [(False, "Command declined by user before administrator authentication.")] * len(commands)
+    timeout = COMMAND_TIMEOUT * len(commands)
+    print(f"INFO: Running {len(commands)} privileged command(s) with one {method} authentication...")
+
+    try:
+        if method == "runas":
+            # RunAs does not return output, so the batch shares one exit status
+            joined = " & ".join(expanded)
+            ps_command = f'Start-Process -FilePath "cmd" -ArgumentList "/c {joined}" -Verb RunAs -Wait -PassThru'
+            result = subprocess.run(["powershell", "-Command", ps_command], capture_output=True, text=True, timeout=timeout)
+            if result.returncode == 0:
+                print("INFO: Dangerous command executed successfully with administrator privileges.")
+                return [(True, result.stdout)] + [(True, "Ran in the same elevated session as the previous step.")] * (len(commands) - 1)
+            print(f"ERROR: Dangerous command failed or was cancelled. {result.stderr}\nERROR 142")
+            return [(False, f"Command cancelled or failed: {result.stderr}")] * len(commands)
+
+        marker = f"__KB_STEP_{secrets.token_hex(8)}__"
+        script = ""
+        for i, command in enumerate(expanded):
+            script += f"printf '\\n%s %d\\n' '{marker}' {i}; printf '\\n%s %d\\n' '{marker}' {i} >&2; ( eval {shlex.quote(command)} ) </dev/null; printf '\\n%s %d %d\\n' '{marker}_END' {i} \"$?\"\n"
+        launcher = ["pkexec", "bash", "-c", script] if method == "pkexec" else ["sudo", "bash", "-c", script]
+        result = subprocess.run(launcher, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print("ERROR: Administrator authentication timed out.")
+        return [(False, "Command timed out during authentication")] * len(commands)
+    except Exception as e:
+        print(f"ERROR: Failed to prompt for administrator confirmation: {e}\nERROR 141")
+        return [(False, "Failed to authenticate as administrator")] * len(commands)
+
+    results = []
+    for i in range(len(commands)):
+        start = result.stdout.find(f"\n{marker} {i}\n")
+        end = result.stdout.find(f"\n{marker}_END {i} ")
+        stderr_start = result.stderr.find(f"\n{marker} {i}\n")
+        stderr_end = result.stderr.find(f"\n{marker} {i + 1}\n")
+        if start == -1 or end == -1:
+            # Authentication was declined or the session ended before this step
+            print(f"ERROR: Dangerous command failed or was cancelled. {result.stderr}\nERROR 142")
+            results.append((False, f"Command cancelled or failed: {result.stderr}"))
+            continue
+        stdout = result.stdout[start + len(f"\n{marker} {i}\n"):end]
+        stderr = result.stderr[stderr_start + len(f"\n{marker} {i}\n"):stderr_end if stderr_end != -1 else len(result.stderr)] if stderr_start != -1 else ""
+        try:
+            returncode = int(result.stdout[end + len(f"\n{marker}_END {i} "):].split("\n", 1)[0])
+        except ValueError:
+            returncode = -1
+        if returncode == 0:
+            print(f"INFO: Dangerous command executed successfully with administrator privileges: {commands[i]}")
+            results.append((True, stdout))
         else:
-            hide_status_indicator()
-            print("WARNING: Unknown operating system. Running dangerous command without elevation.")
-    
-    print(f"INFO: Running USER command: {command}")
-    result = subprocess.run(command, shell=True, timeout=45, capture_output=True, text=True)
+            print(f"ERROR: Dangerous command failed or was cancelled. {stderr}\nERROR 142")
+            results.append((False, f"Command cancelled or failed: {stderr}"))
+    return results
+
+# Run consecutive privileged steps of a task list with a single authentication
+# Returns whether each step succeeded
+def privileged_batch_call(commands, execution, step_nums):
+    show_status_indicator("Executing", "#00FF22")
+    commands = [command.replace("$LAST_OUTPUT", execution.last_output) for command in commands]
+    COMMAND_CACHE.clear()
+    results = run_privileged_batch(commands)
     hide_status_indicator()
-    PREVIOUS_COMMAND_OUTPUT = result.stdout
-    CONVERSATION_HISTORY.add_message("LCO", PREVIOUS_COMMAND_OUTPUT)
+
+    succeeded = []
+    for command, step_num, (ok, output) in zip(commands, step_nums, results):
+        execution.history.add_message("LCI", command)
+        execution.previous_output = output
+        execution.history.add_message("LCO", output)
+        execution.store_output(step_num, output, output, "", 0 if ok else 1)
+        succeeded.append(ok)
+    return succeeded
 
 # Truncate the middle of an input
 def truncate_middle(pco, max_length = 800):
@@ -1412,13 +3513,138 @@ def truncate_middle(pco, max_length = 800):
 
     return head + " [TRUNCATED] " + tail
 
+# Condense command output to fit the prompt, keeping the lines most relevant to the query
+# Runs of repeated lines are collapsed and table-shaped output gets a per-column summary
+def condense_output(output, query, max_length = 800):
+    if len(output) <= max_length:
+        return output
+
+    # Collapse runs of the same line into one line with a count, keeping the order of the output
+    order = []
+    counts = []
+    for line in output.splitlines():
+        line = line.rstrip()
+        if not line.strip():
+            continue
+        if order and order[-1] == line:
+            counts[-1] += 1
+        else:
+            order.append(line)
+            counts.append(1)
+    lines = [line if count == 1 else f"{line} [x{count}]" for line, count in zip(order, counts)]
+    lines = [truncate_middle(line, 200) for line in lines]
+    collapsed = "\n".join(lines)
+    if len(collapsed) <= max_length or len(lines) <= 2:
+        return truncate_middle(collapsed, max_length)
+
+    header = []
+    table_summary = summarize_table(order)
+    if table_summary:
+        header = [table_summary]
+
+    # Score lines by fuzzy relevance to the words of the query
+    keywords = [word for word in re.findall(r"[\w.\-]{3,}", query.lower()) if word not in CONDENSE_STOPWORDS]
+    # Keywords matched by few lines weigh more than ones matched by many
+    scores = [0.0] * len(lines)
+    if keywords:
+        lowered = [line.lower() for line in lines]
+        for keyword in keywords:
+            matches = process.extract(keyword, lowered, scorer=fuzz.partial_ratio, score_cutoff=90, limit=None)
+            for _, score, i in matches:
+                scores[i] += score / math.sqrt(len(matches))
+    for i, line in enumerate(lines):
+        if re.search(r"error|fail|denied|not found|warning", line, re.IGNORECASE):
+            scores[i] += 50
+
+    # Always keep the first and last line, then add the best scoring lines until the budget is used
+    budget = max_length - sum(len(line) + 1 for line in header)
+    keep = {0, len(lines) - 1}
+    used = len(lines[0]) + len(lines[-1]) + 2
+    for i in sorted(range(1, len(lines) - 1), key=lambda i: (-scores[i], i)):
+        if used + len(lines[i]) + 1 > budget:
+            continue
+        keep.add(i)
+        used += len(lines[i]) + 1
+
+    def assemble():
+        result = list(header)
+        previous = -1
+        for i in sorted(keep):
+            if i - previous > 1:
+                result.append(f"[... {i - previous - 1} lines omitted ...]")
+            result.append(lines[i])
+            previous = i
+        return "\n".join(result)
+
+    # Omission markers take space too, so drop the weakest lines until the result fits
+    condensed = assemble()
+    droppable = sorted(keep - {0, len(lines) - 1}, key=lambda i: (scores[i], -i))
+    while len(condensed) > max_length and droppable:
+        keep.discard(droppable.pop(0))
+        condensed = assemble()
+    return truncate_middle(condensed, max_length)
+
+# Summarize output where most lines have the same number of columns, or return None
+def summarize_table(lines):
+    rows = [line.split() for line in lines]
+    widths = [len(row) for row in rows if len(row) >= 2]
+    if len(widths) < 5:
+        return None
+    width = max(set(widths), key=widths.count)
+    table = [row for row in rows if len(row) == width]
+    if len(table) < 0.7 * len(rows):
+        return None
+
+    def is_number(value):
+        try:
+            float(value.rstrip("%"))
+            return True
+        except ValueError:
+            return False
+
+    # Treat the first row as a header when it has words where the other rows have numbers
+    has_header = any(not is_number(table[0][index]) and all(is_number(row[index]) for row in table[1:]) for index in range(width))
+    names = table[0] if has_header else [f"col{index + 1}" for index in range(width)]
+    body = table[1:] if has_header else table
+
+    columns = []
+    for index in range(width):
+        values = [row[index] for row in body]
+        numbers = [float(value.rstrip("%")) for value in values if is_number(value)]
+        name = names[index]
+        if values and len(numbers) == len(values):
+            columns.append(f"{name} ({min(numbers):g}-{max(numbers):g})")
+        else:
+            columns.append(f"{name} ({len(set(values))} distinct)")
+    return f"[TABLE {len(body)} rows: {', '.join(columns)}]"
+
+# Returns the system profile digest as a prompt section, or nothing until the profile has been collected
+def get_system_context():
+    digest = SYSTEM_PROFILE.digest()
+    if not digest:
+        return ""
+    return f"SYSTEM:\n{digest}\n"
+
 # AI Call Method
-def ai_call(task_list):
-    global OS_VERSION, PROMPT, PREVIOUS_COMMAND_OUTPUT, USER_INTENT
-    combined_prompt = f"OS: {OS_VERSION}\nDEFAULT PATH: {Path.home() / 'Desktop'}\nConversation History:\n{CONVERSATION_HISTORY.get_formatted_history()}\n{PROMPT}\nLast Command Output:\n{truncate_middle(PREVIOUS_COMMAND_OUTPUT)}\nUser Intent:{USER_INTENT}\nTodo List:\n{format_todo_list(task_list)}"
+# Returns the generated response for the task loop to process
+def ai_call(task_list, execution):
+    global OS_VERSION, PROMPT
+    pending_step = next((command for _, command, _, status in task_list if status == "DO NEXT"), "")
+    command_output = condense_output(execution.previous_output, f"{execution.command} {pending_step}")
+    combined_prompt = f"OS: {OS_VERSION}\nDEFAULT PATH: {Path.home() / 'Desktop'}\n{get_system_context()}Conversation History:\n{execution.history.get_formatted_history()}\n{PROMPT}\nLast Command Output:\n{command_output}\nUser Intent:{execution.command}\nTodo List:\n{format_todo_list(task_list)}"
     print("INFO: Generating response...")
-    response_text = generate_text(combined_prompt)
-    process_response(response_text)
+    return execution_generate(execution, combined_prompt)
+
+# Generate text for an intent and charge the call against its budget
+def execution_generate(execution, input_prompt):
+    execution.ai_calls += 1
+    execution.add_tokens(input_prompt)
+    response_text = generate_text(input_prompt, execution.cancel_token)
+    if execution.cancel_token.is_cancelled():
+        execution.stop_reason = execution.cancel_token.reason
+        return None
+    execution.add_tokens(response_text)
+    return response_text
 
 # Formats parsed todo list back into string
 def format_todo_list(todo_list):
@@ -1513,6 +3739,8 @@ def show_overlay(text):
         root.after(len(text) * 15 + 5000, root.destroy)
         root.mainloop()
 
+    if HEADLESS:
+        return
     threading.Thread(target=open_overlay).start()
 
 def show_status_indicator(text="Listening", dot_color="#4FA4FF"):
@@ -1596,31 +3824,1057 @@ def hide_status_indicator():
     # Schedule the destruction
     DASHBOARD_ROOT.after(0, _destroy)
 
+# Class for cancelling a single intent from another thread
+# Callbacks such as killing a running command are called once when the token is cancelled
+class CancelToken:
+    def __init__(self):
+        self.event = threading.Event()
+        self.reason = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def is_cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self, reason="Cancelled by user"):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.event.set()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"ERROR: Failed to stop cancelled intent: {e}\nERROR 169")
+
+    # Call a callback on cancel, right away if the token is already cancelled
+    def register(self, callback):
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        callback()
+
+    def unregister(self, callback):
+        with self.lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+# Class for tracking the state, timing and budgets of a single user intent
+# Each intent keeps its own command output and response so overlapping commands cannot overwrite each other
+class IntentExecution:
+    def __init__(self, command, history=None, isolated=False, cancel_token=None):
+        self.command = command
+        self.cancel_token = cancel_token if cancel_token is not None else CancelToken()
+        self.history = history if history is not None else CONVERSATION_HISTORY
+        self.isolated = isolated
+        self.previous_output = ""
+        self.last_output = "" if isolated else LAST_OUTPUT
+        self.start_time = time.time()
+        self.ai_calls = 0
+        self.tokens = 0
+        self.step_records = []
+        self.step_outputs = {}
+        self.stop_reason = None
+
+    # Keep a response designated for the user and publish it to the dashboard
+    def set_last_output(self, text):
+        global LAST_OUTPUT
+        self.last_output = text
+        if not self.isolated:
+            LAST_OUTPUT = text
+        self.history.add_message("AI", text)
+
+    # Estimate tokens from text length (about 4 characters per token)
+    def add_tokens(self, text):
+        if text:
+            self.tokens += len(text) // 4 + 1
+
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    # Returns the reason the intent was cancelled or the time budget is exhausted, or None
+    def check_time(self):
+        if self.cancel_token.is_cancelled():
+            return self.cancel_token.reason
+        if self.elapsed() >= MAX_INTENT_TIME:
+            return f"Time limit of {MAX_INTENT_TIME} seconds reached"
+        return None
+
+    # Returns the reason any budget is exhausted, or None if another AI call is allowed
+    def check_budget(self):
+        if self.ai_calls >= MAX_AI_CALLS:
+            return f"Limit of {MAX_AI_CALLS} AI calls reached"
+        if self.tokens >= MAX_INTENT_TOKENS:
+            return f"Limit of {MAX_INTENT_TOKENS} tokens reached"
+        return self.check_time()
+
+    # Returns the state recorded for a finished step
+    def step_state(self, succeeded):
+        if succeeded:
+            return "DONE"
+        return "CANCELLED" if self.cancel_token.is_cancelled() else "FAILED"
+
+    # Record the final state and duration of a step
+    def record_step(self, step_num, executor, command, state, started):
+        duration = time.time() - started
+        self.step_records.append({
+            "step": str(step_num),
+            "executor": executor,
+            "input": command,
+            "state": state,
+            "start": round(started - self.start_time, 3),
+            "duration": round(duration, 3)
+        })
+        print(f"INFO: Step {step_num} ({executor}) {state} in {duration:.2f}s")
+
+    # Keep the output of a USER step so later steps can reference it with $STEP[n]
+    def store_output(self, step_num, output, stdout, stderr, code, truncated=False):
+        self.step_outputs[str(step_num)] = {"output": output, "stdout": stdout, "stderr": stderr, "code": code, "truncated": truncated}
+
+    def print_summary(self):
+        status = f"stopped ({self.stop_reason})" if self.stop_reason else "completed"
+        print(f"INFO: Intent {status} in {self.elapsed():.2f}s ({len(self.step_records)} steps, {self.ai_calls} AI calls, ~{self.tokens} tokens)")
+
+# Class for a command waiting in or taken from the command queue
+class QueuedCommand:
+    def __init__(self, command_id, command, priority, on_finished=None):
+        self.id = command_id
+        self.command = command
+        self.priority = priority
+        self.on_finished = on_finished
+        self.queued = time.time()
+        self.started = None
+        self.cancelled = False
+        self.cancel_token = CancelToken()
+
+    def __lt__(self, other):
+        return (self.priority, self.id) < (other.priority, other.id)
+
+# Class for the single queue that voice and dashboard commands go through
+# Spoken commands run before typed ones and at most MAX_CONCURRENT_INTENTS run at the same time
+class CommandQueue:
+    def __init__(self, workers):
+        self.workers = workers
+        self.pending = queue.PriorityQueue()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.waiting = 0
+        self.running = []
+        self.threads = []
+        self.closed = False
+        self.last_wait = 0.0
+
+    def start(self):
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    # Returns the queued command, or None when the queue is full or stopped
+    def submit(self, command, priority=PRIORITY_TYPED, on_finished=None):
+        with self.lock:
+            if self.closed:
+                return None
+            if self.waiting >= MAX_QUEUED_COMMANDS:
+                print(f"WARNING: Command queue is full, dropping command: {command}\nWARN 325")
+                return None
+            item = QueuedCommand(self.next_id, command, priority, on_finished)
+            self.next_id += 1
+            self.waiting += 1
+            self.pending.put(item)
+        self.start()
+        print(f"INFO: Queued command {item.id} ({self.waiting} waiting): {command}")
+        return item
+
+    # Cancel a waiting command, or stop a running one at its next step
+    def cancel(self, command_id):
+        with self.lock:
+            for item in list(self.pending.queue):
+                if item.id == command_id and not item.cancelled:
+                    item.cancelled = True
+                    self.waiting -= 1
+                    print(f"INFO: Cancelled queued command {item.id}: {item.command}")
+                    return True
+            running = [item for item in self.running if item.id == command_id]
+        for item in running:
+            print(f"INFO: Cancelling running command {item.id}: {item.command}")
+            item.cancel_token.cancel()
+        return bool(running)
+
+    # Stop every running command, returns how many were cancelled
+    def cancel_running(self):
+        with self.lock:
+            running = list(self.running)
+        for item in running:
+            print(f"INFO: Cancelling running command {item.id}: {item.command}")
+            item.cancel_token.cancel()
+        return len(running)
+
+    def cancel_pending(self):
+        with self.lock:
+            items = [item for item in self.pending.queue if not item.cancelled]
+        for item in items:
+            self.cancel(item.id)
+        return len(items)
+
+    def work(self):
+        while not self.closed:
+            item = self.pending.get()
+            if item.command is None:
+                return
+            if item.cancelled:
+                continue
+            with self.lock:
+                self.waiting -= 1
+                self.running.append(item)
+            item.started = time.time()
+            self.last_wait = item.started - item.queued
+            print(f"INFO: Running command {item.id} after waiting {self.last_wait:.2f}s ({self.waiting} waiting)")
+            execution = None
+            error = None
+            try:
+                execution = process_command(item.command, cancel_token=item.cancel_token)
+            except Exception as e:
+                error = e
+                print(f"ERROR: Failed to process command: {e}\nERROR 166")
+            finally:
+                with self.lock:
+                    self.running.remove(item)
+            if item.on_finished is not None:
+                item.on_finished(execution, error)
+
+    # Returns a short description of queue depth and wait time for the dashboard
+    def status_text(self):
+        with self.lock:
+            waiting = self.waiting
+            running = len(self.running)
+            oldest = min((item.queued for item in self.pending.queue if not item.cancelled), default=None)
+        if not waiting and not running:
+            return "Idle"
+        text = f"{running} running, {waiting} queued"
+        if oldest is not None:
+            text += f" (oldest {time.time() - oldest:.0f}s)"
+        return text
+
+    def shutdown(self):
+        self.cancel_pending()
+        self.cancel_running()
+        with self.lock:
+            self.closed = True
+            threads = list(self.threads)
+        # Workers stop when they reach these markers, after any command already running
+        for _ in threads:
+            self.pending.put_nowait(QueuedCommand(0, None, float("inf")))
+
+# Class for storing successful task lists with the arguments of the command abstracted into slots
+class PlanCache:
+    # Words that describe the action or location and must match exactly instead of becoming slots
+    FIXED_WORDS = {"a", "an", "the", "called", "named", "on", "in", "my", "to", "into", "from", "of", "and", "with", "for", "at",
+                   "folder", "file", "directory", "desktop", "documents", "downloads", "home", "create", "make", "new", "delete",
+                   "remove", "move", "rename", "copy", "read", "open", "write", "find", "search", "please", "it", "this", "that"}
+
+    def __init__(self, path):
+        self.path = path
+        self.plans = None
+        self.lock = threading.Lock()
+
+    def tokenize(self, command):
+        return re.findall(r"[A-Za-z0-9_.\-]+", command)
+
+    def load(self):
+        if self.plans is not None:
+            return
+        try:
+            with open(self.path, "r") as f:
+                self.plans = json.load(f)
+        except FileNotFoundError:
+            self.plans = {}
+        except Exception as e:
+            print(f"ERROR: Failed to load plan cache: {e}\nERROR 152")
+            self.plans = {}
+
+    def save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.plans, f)
+        except Exception as e:
+            print(f"ERROR: Failed to save plan cache: {e}\nERROR 153")
+
+    # Store the task list of a command that finished in one generation with every step DONE
+    def learn(self, command, response, execution):
+        todo_list = extract_todo_list(response)
+        if not todo_list or any(executor != "USER" for _, _, executor, _ in todo_list):
+            return
+        user_records = [record for record in execution.step_records if record["executor"] == "USER"]
+        if len(user_records) != len(todo_list) or any(record["state"] != "DONE" for record in user_records):
+            return
+        steps = [step for _, step, _, _ in todo_list]
+        if any("$LAST_OUTPUT" in step for step in steps):
+            return
+        text = extract_user_output(response) or ""
+
+        template = []
+        slots = 0
+        for token in self.tokenize(command):
+            pattern = re.compile(rf"(?<![\w.\-]){re.escape(token)}(?![\w\-])")
+            if token.lower() not in self.FIXED_WORDS and any(pattern.search(step) for step in steps):
+                marker = f"{{{{SLOT{slots}}}}}"
+                steps = [pattern.sub(lambda _: marker, step) for step in steps]
+                text = pattern.sub(lambda _: marker, text)
+                template.append(marker)
+                slots += 1
+            else:
+                template.append(token.lower())
+
+        key = " ".join(template)
+        if not self.is_safe_plan(template, steps):
+            return
+        with self.lock:
+            self.load()
+            self.plans.pop(key, None)
+            self.plans[key] = {"steps": steps, "response": text, "created": time.time()}
+            while len(self.plans) > PLAN_CACHE_SIZE:
+                self.plans.pop(next(iter(self.plans)))
+            self.save()
+        print(f"INFO: Cached plan for '{key}'")
+
+    # Returns whether a plan is specific enough to replay without a model and cannot destroy anything if a slot is filled wrong
+    # A short template like "make {{SLOT0}}" would match almost any command
+    def is_safe_plan(self, template, steps):
+        fixed = sum(1 for word in template if not word.startswith("{{SLOT"))
+        slots = len(template) - fixed
+        if fixed < PLAN_CACHE_MIN_FIXED or fixed < slots * PLAN_CACHE_FIXED_PER_SLOT:
+            return False
+        for step in steps:
+            parsed = parse_tool_call(step)
+            if parsed is None:
+                # Terminal commands like mv, rm or find -delete are only replayed when they cannot change anything
+                if is_privileged_command(step) or not is_read_only_command(step):
+                    return False
+                continue
+            calls = [parse_tool_call(call) for call in parsed[1]] if parsed[0] == "batch" else [parsed]
+            if any(call is None or call[0] in PLAN_CACHE_UNSAFE_TOOLS for call in calls):
+                return False
+        return True
+
+    # Returns (key, steps, response) with slots filled in for the matching plan with the most fixed words, or None
+    def match(self, command):
+        tokens = self.tokenize(command)
+        with self.lock:
+            self.load()
+            plans = list(self.plans.items())
+
+        best = None
+        for key, plan in plans:
+            template = key.split(" ")
+            # Plans cached before the safety rules were added are checked again
+            if len(template) != len(tokens) or not self.is_safe_plan(template, plan["steps"]):
+                continue
+            fixed = [(word, token.lower()) for word, token in zip(template, tokens) if not word.startswith("{{SLOT")]
+            if any(word != token for word, token in fixed):
+                continue
+            if best is None or len(fixed) > best[0]:
+                best = (len(fixed), key, plan, template)
+        if best is None:
+            return None
+
+        fixed, key, plan, template = best
+        steps = plan["steps"]
+        response = plan["response"]
+        for word, token in zip(template, tokens):
+            if word.startswith("{{SLOT"):
+                steps = [step.replace(word, token) for step in steps]
+                response = response.replace(word, token)
+        print(f"INFO: Matched cached plan '{key}' ({fixed} fixed words)")
+        return key, steps, response
+
+    def forget(self, key):
+        with self.lock:
+            self.load()
+            if self.plans.pop(key, None) is not None:
+                self.save()
+
+PLAN_CACHE = PlanCache(get_source_path("plan_cache"))
+COMMAND_QUEUE = CommandQueue(MAX_CONCURRENT_INTENTS)
+
+# Class for a cached profile of the system that is refreshed in the background and summarized into prompts
+class SystemProfile:
+    # Seconds each section stays valid before it is collected again
+    SECTION_TTLS = {"paths": 86400, "shells": 86400, "packages": 86400, "apps": 21600, "hardware": 3600, "disks": 60}
+    SHELLS = ["bash", "zsh", "fish", "sh", "pwsh", "powershell", "cmd"]
+    PACKAGE_MANAGERS = ["apt", "dnf", "yum", "pacman", "zypper", "apk", "brew", "port", "winget", "choco", "scoop", "flatpak", "snap", "pip3", "npm"]
+    APPS = ["firefox", "google-chrome", "chromium", "brave-browser", "code", "gedit", "kate", "nano", "vim", "libreoffice", "vlc", "gimp",
+            "thunderbird", "nautilus", "dolphin", "thunar", "explorer", "notepad", "python3", "python", "git", "docker", "ollama", "ffmpeg", "7z", "zip"]
+
+    def __init__(self, path):
+        self.path = path
+        self.sections = None
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.thread = None
+
+    def load(self):
+        if self.sections is not None:
+            return
+        try:
+            with open(self.path, "r") as f:
+                self.sections = json.load(f)
+        except FileNotFoundError:
+            self.sections = {}
+        except Exception as e:
+            print(f"ERROR: Failed to load system profile: {e}\nERROR 163")
+            self.sections = {}
+
+    def save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self.sections, f)
+        except Exception as e:
+            print(f"ERROR: Failed to save system profile: {e}\nERROR 164")
+
+    # Collect every section that is missing or past its TTL
+    # Returns True if any section changed
+    def refresh(self):
+        if not self.refreshing.acquire(blocking=False):
+            return False
+        try:
+            with self.lock:
+                self.load()
+                now = time.time()
+                stale = [name for name, ttl in self.SECTION_TTLS.items()
+                         if now - self.sections.get(name, {}).get("collected", 0) >= ttl]
+            changed = False
+            for name in stale:
+                try:
+                    data = getattr(self, f"collect_{name}")()
+                except Exception as e:
+                    print(f"ERROR: Failed to collect {name} for system profile: {e}\nERROR 165")
+                    continue
+                with self.lock:
+                    previous = self.sections.get(name, {}).get("data")
+                    self.sections[name] = {"data": data, "collected": time.time()}
+                    changed = changed or data != previous
+            if stale:
+                with self.lock:
+                    self.save()
+            return changed
+        finally:
+            self.refreshing.release()
+
+    # Refresh the profile on a background thread until the app stops
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        def loop():
+            while not STOP_EVENT.is_set():
+                self.refresh()
+                STOP_EVENT.wait(min(self.SECTION_TTLS.values()))
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+
+    def collect_paths(self):
+        home = Path.home()
+        paths = {"home": str(home)}
+        folders = {"Desktop": "DESKTOP", "Documents": "DOCUMENTS", "Downloads": "DOWNLOAD", "Pictures": "PICTURES", "Music": "MUSIC", "Videos": "VIDEOS"}
+        # Linux desktops can move or translate these folders through user-dirs.dirs
+        user_dirs = {}
+        try:
+            with open(home / ".config" / "user-dirs.dirs", "r") as f:
+                for line in f:
+                    match = re.match(r'XDG_(\w+)_DIR="(.*)"', line.strip())
+                    if match:
+                        user_dirs[match.group(1)] = match.group(2).replace("$HOME", str(home))
+        except OSError:
+            pass
+        for name, xdg in folders.items():
+            folder = Path(user_dirs.get(xdg, home / name))
+            if folder.is_dir():
+                paths[name] = str(folder)
+        return paths
+
+    def collect_shells(self):
+        shells = [name for name in self.SHELLS if shutil.which(name)]
+        default = os.environ.get("SHELL") or os.environ.get("COMSPEC") or ""
+        return {"available": shells, "default": os.path.basename(default)}
+
+    def collect_packages(self):
+        return [name for name in self.PACKAGE_MANAGERS if shutil.which(name)]
+
+    def collect_apps(self):
+        apps = [name for name in self.APPS if shutil.which(name)]
+        if platform.system() == "Darwin":
+            try:
+                apps += sorted(entry[:-4] for entry in os.listdir("/Applications") if entry.endswith(".app"))
+            except OSError:
+                pass
+        return apps
+
+    def collect_hardware(self):
+        return {"cpus": psutil.cpu_count() or 0, "memory_gb": round(psutil.virtual_memory().total / 1024 ** 3, 1)}
+
+    def collect_disks(self):
+        disks = []
+        for partition in psutil.disk_partitions(all=False):
+            if partition.mountpoint.startswith(("/snap", "/boot", "/var/snap")) or "loop" in partition.device:
+                continue
+            try:
+                usage = psutil.disk_usage(partition.mountpoint)
+            except (OSError, PermissionError):
+                continue
+            disks.append({"mount": partition.mountpoint, "fs": partition.fstype,
+                          "free_gb": round(usage.free / 1024 ** 3, 1), "total_gb": round(usage.total / 1024 ** 3, 1)})
+        return disks[:6]
+
+    # Returns a compact one-line-per-section summary for prompts, empty until the first refresh finishes
+    def digest(self):
+        with self.lock:
+            self.load()
+            sections = {name: section.get("data") for name, section in self.sections.items()}
+        lines = []
+        if sections.get("paths"):
+            lines.append("Paths: " + ", ".join(f"{name}={path}" for name, path in sections["paths"].items()))
+        if sections.get("shells"):
+            shells = sections["shells"]
+            lines.append(f"Shells: {', '.join(shells['available'])} (default {shells['default'] or 'unknown'})")
+        if sections.get("packages"):
+            lines.append("Package managers: " + ", ".join(sections["packages"]))
+        if sections.get("apps"):
+            lines.append("Apps: " + truncate_middle(", ".join(sections["apps"]), 300))
+        if sections.get("hardware"):
+            lines.append(f"Hardware: {sections['hardware']['cpus']} CPUs, {sections['hardware']['memory_gb']}GB RAM")
+        if sections.get("disks"):
+            lines.append("Disks: " + ", ".join(f"{disk['mount']} ({disk['fs']}, {disk['free_gb']}/{disk['total_gb']}GB free)" for disk in sections["disks"]))
+        return "\n".join(lines)
+
+SYSTEM_PROFILE = SystemProfile(get_source_path("system_profile"))
+
+# Class for a persistent SQLite index of file and folder names under FILE_INDEX_ROOTS
+# Names are split into trigrams so ds can prefilter whole trees before fuzzy scoring
+# A polling thread rescans folders whose mtime changed, since adding, removing or renaming an entry updates it
+class FileIndex:
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.thread = None
+        self.roots = []
+
+    def open(self):
+        if self.connection is not None:
+            return True
+        try:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, parent TEXT, name TEXT, is_dir INTEGER);
+                CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+                CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime REAL);
+                CREATE TABLE IF NOT EXISTS trigrams (gram TEXT, file_id INTEGER, PRIMARY KEY (gram, file_id)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS trigrams_file ON trigrams (file_id);
+            """)
+            return True
+        except Exception as e:
+            print(f"ERROR: Failed to open file index: {e}\nERROR 172")
+            self.connection = None
+            return False
+
+    @staticmethod
+    def trigrams(name):
+        name = name.lower()
+        return {name[i:i + 3] for i in range(len(name) - 2)}
+
+    # Build or catch up the index, then keep polling for changes until the app stops
+    def start(self):
+        self.roots = [os.path.realpath(os.path.expanduser(root)) for root in FILE_INDEX_ROOTS]
+        self.roots = [root for root in self.roots if os.path.isdir(root)]
+        if not self.roots or (self.thread is not None and self.thread.is_alive()):
+            return
+        if not self.open():
+            return
+        def loop():
+            try:
+                self.sync()
+                self.ready.set()
+                print(f"INFO: File index ready for {', '.join(self.roots)}")
+                while not STOP_EVENT.wait(FILE_INDEX_POLL):
+                    self.sync()
+            except Exception as e:
+                print(f"ERROR: Failed to update file index: {e}\nERROR 173")
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+
+    # Rescan every indexed folder whose mtime changed and index roots seen for the first time
+    def sync(self):
+        with self.lock:
+            known = dict(self.connection.execute("SELECT path, mtime FROM dirs").fetchall())
+            # Forget folders from roots that were removed from the settings
+            stale = [path for path in known if not any(self.contains(root, path) for root in self.roots)]
+            for path in stale:
+                self.remove_tree(path)
+                known.pop(path)
+            self.connection.commit()
+        changed = []
+        for path, mtime in known.items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    changed.append(path)
+            except OSError:
+                changed.append(path)
+        for root in self.roots:
+            if root not in known:
+                changed.append(root)
+        for path in changed:
+            self.rescan(path)
+
+    @staticmethod
+    def contains(root, path):
+        return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+    # Update the direct entries of a folder, indexing new subfolders fully
+    def rescan(self, folder):
+        with self.lock:
+            try:
+                mtime = os.stat(folder).st_mtime
+                entries = {entry.path: entry.is_dir(follow_symlinks=False) for entry in os.scandir(folder)
+                           if not (entry.is_dir(follow_symlinks=False) and entry.name in PRUNED_DIRS)}
+            except OSError:
+                self.remove_tree(folder)
+                self.connection.commit()
+                return
+            indexed = dict(self.connection.execute("SELECT path, is_dir FROM files WHERE parent = ?", (folder,)).fetchall())
+            for path in set(indexed) - set(entries):
+                if indexed[path]:
+                    self.remove_tree(path)
+                else:
+                    self.remove_file(path)
+            new_dirs = []
+            for path, is_dir in entries.items():
+                if path not in indexed:
+                    self.add_file(path, folder, is_dir)
+                    if is_dir:
+                        new_dirs.append(path)
+            self.connection.execute("INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)", (folder, mtime))
+            self.connection.commit()
+        for path in new_dirs:
+            self.rescan(path)
+
+    def add_file(self, path, parent, is_dir):
+        cursor = self.connection.execute("INSERT OR IGNORE INTO files (path, parent, name, is_dir) VALUES (?, ?, ?, ?)",
+                                         (path, parent, os.path.basename(path), int(is_dir)))
+        if cursor.rowcount:
+            self.connection.executemany("INSERT OR IGNORE INTO trigrams (gram, file_id) VALUES (?, ?)",
+                                        [(gram, cursor.lastrowid) for gram in self.trigrams(os.path.basename(path))])
+
+    def remove_file(self, path):
+        row = self.connection.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        if row:
+            self.connection.execute("DELETE FROM trigrams WHERE file_id = ?", row)
+            self.connection.execute("DELETE FROM files WHERE id = ?", row)
+
+    def remove_tree(self, path):
+        prefix = path.rstrip(os.sep) + os.sep
+        ids = self.connection.execute("SELECT id FROM files WHERE path = ? OR instr(path, ?) = 1", (path, prefix)).fetchall()
+        self.connection.executemany("DELETE FROM trigrams WHERE file_id = ?", ids)
+        self.connection.executemany("DELETE FROM files WHERE id = ?", ids)
+        self.connection.execute("DELETE FROM dirs WHERE path = ? OR instr(path, ?) = 1", (path, prefix))
+
+    # Returns whether the index can answer a search under a folder
+    # Folders inside PRUNED_DIRS are never indexed, so searches there fall back to walking the tree
+    def covers(self, folder):
+        folder = os.path.realpath(folder)
+        for root in self.roots:
+            if self.contains(root, folder):
+                return self.ready.is_set() and not any(part in PRUNED_DIRS for part in os.path.relpath(folder, root).split(os.sep))
+        return False
+
+    # Returns (path, name) candidates under a folder whose names share enough trigrams with the query
+    def candidates(self, folder, query):
+        folder = os.path.realpath(folder)
+        prefix = folder.rstrip(os.sep) + os.sep
+        # Catch up on every indexed folder under the search root, since a step may have just changed any of them
+        with self.lock:
+            known = self.connection.execute("SELECT path, mtime FROM dirs WHERE path = ? OR instr(path, ?) = 1", (folder, prefix)).fetchall()
+        for path, mtime in known:
+            try:
+                changed = os.stat(path).st_mtime != mtime
+            except OSError:
+                changed = True
+            if changed:
+                self.rescan(path)
+
+        grams = sorted(self.trigrams(query))
+        with self.lock:
+            if not grams:
+                rows = self.connection.execute("SELECT path, name FROM files WHERE instr(path, ?) = 1 AND instr(lower(name), ?) > 0 LIMIT ?",
+                                               (prefix, query.lower(), FILE_INDEX_MAX_CANDIDATES)).fetchall()
+                return rows
+            # A name must share at least half of the query trigrams to be scored
+            needed = max(1, len(grams) // 2)
+            placeholders = ", ".join("?" for _ in grams)
+            rows = self.connection.execute(f"""
+                SELECT files.path, files.name FROM
+                    (SELECT file_id, COUNT(*) AS shared FROM trigrams WHERE gram IN ({placeholders}) GROUP BY file_id HAVING shared >= ?) AS hits
+                JOIN files ON files.id = hits.file_id
+                WHERE instr(files.path, ?) = 1
+                ORDER BY hits.shared DESC LIMIT ?""", (*grams, needed, prefix, FILE_INDEX_MAX_CANDIDATES)).fetchall()
+        return rows
+
+FILE_INDEX = FileIndex(get_source_path("file_index.db"))
+
+# Class for an optional SQLite FTS5 index of the text inside documents under FILE_INDEX_ROOTS
+class ContentIndex:
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.error = None # Why the index cannot be used, eg. SQLite built without FTS5
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.thread = None
+        self.roots = []
+
+    def open(self):
+        if self.connection is not None:
+            return True
+        try:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER);
+                CREATE VIRTUAL TABLE IF NOT EXISTS content USING fts5(body, tokenize='trigram');
+            """)
+            return True
+        except sqlite3.OperationalError as e:
+            # FTS5 and its trigram tokenizer (SQLite 3.34+) are optional parts of SQLite builds
+            if "fts5" in str(e).lower() or "tokenizer" in str(e).lower():
+                self.error = f"this SQLite build has no FTS5 trigram support ({e})"
+            else:
+                self.error = f"content_index.db could not be opened ({e})"
+        except Exception as e:
+            self.error = f"content_index.db could not be opened ({e})"
+        print(f"ERROR: Failed to open content index: {self.error}\nERROR 176")
+        self.connection = None
+        return False
+
+    # Catch up the index, then keep checking for changed files until the app stops
+    def start(self):
+        if not CONTENT_INDEX_ENABLED:
+            return
+        self.roots = [os.path.realpath(os.path.expanduser(root)) for root in FILE_INDEX_ROOTS]
+        self.roots = [root for root in self.roots if os.path.isdir(root)]
+        if not self.roots or (self.thread is not None and self.thread.is_alive()):
+            return
+        if not self.open():
+            return
+        def loop():
+            try:
+                self.sync()
+                self.ready.set()
+                print(f"INFO: Content index ready for {', '.join(self.roots)}")
+                while not STOP_EVENT.wait(CONTENT_INDEX_POLL):
+                    self.sync()
+            except Exception as e:
+                if not self.ready.is_set():
+                    self.error = f"building it failed ({e})"
+                print(f"ERROR: Failed to update content index: {e}\nERROR 177")
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+
+    # Compare the files under the roots with the index by mtime and size, then index what changed while the CPU is idle
+    def sync(self):
+        current = {}
+        for root in self.roots:
+            for folder, folders, names in os.walk(root):
+                folders[:] = [name for name in folders if name not in PRUNED_DIRS and not name.startswith(".")]
+                for name in names:
+                    if os.path.splitext(name)[1].lower() not in CONTENT_INDEX_EXTENSIONS:
+                        continue
+                    path = os.path.join(folder, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if stat.st_size <= CONTENT_INDEX_MAX_FILE:
+                        current[path] = (stat.st_mtime, stat.st_size)
+        with self.lock:
+            indexed = {path: (doc_id, mtime, size) for doc_id, path, mtime, size in self.connection.execute("SELECT id, path, mtime, size FROM docs")}
+            for path in set(indexed) - set(current):
+                self.remove(indexed[path][0])
+            self.connection.commit()
+        changed = [path for path, state in current.items() if path not in indexed or indexed[path][1:] != state]
+        for start in range(0, len(changed), CONTENT_INDEX_BATCH):
+            if not self.wait_for_idle():
+                return
+            batch = [(path, current[path], extract_text(path)) for path in changed[start:start + CONTENT_INDEX_BATCH]]
+            with self.lock:
+                for path, (mtime, size), text in batch:
+                    row = self.connection.execute("SELECT id FROM docs WHERE path = ?", (path,)).fetchone()
+                    if row:
+                        self.remove(row[0])
+                    cursor = self.connection.execute("INSERT INTO docs (path, mtime, size) VALUES (?, ?, ?)", (path, mtime, size))
+                    # Files without text are still recorded so they are not extracted again until they change
+                    if text:
+                        self.connection.execute("INSERT INTO content (rowid, body) VALUES (?, ?)", (cursor.lastrowid, text))
+                self.connection.commit()
+
+    # Waits until system CPU use since the last check is low enough to index, returns False if the app is stopping
+    @staticmethod
+    def wait_for_idle():
+        while not STOP_EVENT.is_set():
+            if psutil.cpu_percent(interval=None) < CONTENT_INDEX_IDLE_CPU:
+                return True
+            STOP_EVENT.wait(1)
+        return False
+
+    def remove(self, doc_id):
+        self.connection.execute("DELETE FROM content WHERE rowid = ?", (doc_id,))
+        self.connection.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+
+    # Returns whether the index holds the files of a folder
+    def covers(self, folder):
+        folder = os.path.realpath(folder)
+        return any(FileIndex.contains(root, folder) for root in self.roots)
+
+    # Returns ranked (path, snippet) pairs for documents containing every query term, or None if no term is long enough
+    def search(self, query, folder=None):
+        # The trigram tokenizer can only match terms of 3 or more characters
+        terms = [term for term in query.split() if len(term) >= 3]
+        if not terms:
+            return None
+        match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        prefix = os.path.realpath(folder).rstrip(os.sep) + os.sep if folder else ""
+        with self.lock:
+            rows = self.connection.execute("""
+                SELECT docs.path, snippet(content, 0, '[', ']', '...', 40) FROM content
+                JOIN docs ON docs.id = content.rowid
+                WHERE content MATCH ? AND instr(docs.path, ?) = 1
+                ORDER BY rank LIMIT ?""", (match, prefix, CONTENT_INDEX_RESULTS)).fetchall()
+        return [(path, " ".join(snippet.split())) for path, snippet in rows]
+
+# Returns the text of a document for the content index, or "" if it has none
+def extract_text(path):
+    try:
+        extension = os.path.splitext(path)[1].lower()
+        if extension in [".docx", ".odt"]:
+            # Office documents are zip files holding their text as XML
+            with zipfile.ZipFile(path) as archive:
+                xml = archive.read("word/document.xml" if extension == ".docx" else "content.xml").decode("utf-8", errors="replace")
+            xml = re.sub(r"</(w:p|text:p|text:h)>", "\n", xml)
+            return re.sub(r"<[^>]+>", "", xml)[:CONTENT_INDEX_MAX_TEXT]
+        with open(path, "rb") as f:
+            data = f.read(CONTENT_INDEX_MAX_TEXT)
+        if b"\0" in data[:READ_SAMPLE_SIZE]:
+            return ""
+        return data.decode("utf-8", errors="replace")
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return ""
+
+CONTENT_INDEX = ContentIndex(get_source_path("content_index.db"))
+
+# Class for an optional index of sentence embeddings of file names under FILE_INDEX_ROOTS
+# Vectors are rows of a memory-mapped float16 matrix, rows of deleted files are reused
+class SemanticIndex:
+    def __init__(self, path):
+        self.path = path # Matrix file, the row table is kept next to it as JSON
+        self.model = None
+        self.vectors = None
+        self.rows = [] # [path, mtime] per matrix row, None for free rows
+        self.row_of = {}
+        self.generation = 0 # Bumped whenever rows change, so cached folder masks can be reused until then
+        self.mask_cache = (None, -1, None)
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.thread = None
+        self.roots = []
+
+    # Load the sentence model and the saved index, starting empty if the index is missing or from another model
+    def open(self):
+        if self.model is not None:
+            return True
+        try:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(SEMANTIC_MODEL, device="cpu")
+        except Exception as e:
+            print(f"ERROR: Failed to load semantic search model: {e}\nERROR 180")
+            return False
+        try:
+            with open(self.path + ".json", "r") as f:
+                saved = json.load(f)
+            if saved.get("model") == SEMANTIC_MODEL and os.path.exists(self.path):
+                self.rows = saved["rows"]
+                self.vectors = np.memmap(self.path, dtype=np.float16, mode="r+", shape=(saved["capacity"], SEMANTIC_DIMENSIONS))
+        except (OSError, ValueError, KeyError):
+            self.rows = []
+        if self.vectors is None:
+            self.rows = []
+            self.vectors = np.memmap(self.path, dtype=np.float16, mode="w+", shape=(1024, SEMANTIC_DIMENSIONS))
+        self.row_of = {row[0]: i for i, row in enumerate(self.rows) if row}
+        return True
+
+    # Load the model and catch up the index, then keep checking for changes until the app stops
+    def start(self):
+        if not SEMANTIC_INDEX_ENABLED or np is None:
+            return
+        self.roots = [os.path.realpath(os.path.expanduser(root)) for root in FILE_INDEX_ROOTS]
+        self.roots = [root for root in self.roots if os.path.isdir(root)]
+        if not self.roots or (self.thread is not None and self.thread.is_alive()):
+            return
+        def loop():
+            try:
+                if not self.open():
+                    return
+                self.sync()
+                self.ready.set()
+                print(f"INFO: Semantic index ready for {', '.join(self.roots)}")
+                while not STOP_EVENT.wait(SEMANTIC_POLL):
+                    self.sync()
+            except Exception as e:
+                print(f"ERROR: Failed to update semantic index: {e}\nERROR 181")
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+
+    # Encode new and changed paths in batches and free the rows of removed ones
+    def sync(self):
+        current = {}
+        for root in self.roots:
+            for folder, folders, names in os.walk(root):
+                folders[:] = [name for name in folders if name not in PRUNED_DIRS and not name.startswith(".")]
+                for name in folders + names:
+                    path = os.path.join(folder, name)
+                    try:
+                        current[path] = os.stat(path).st_mtime
+                    except OSError:
+                        continue
+        with self.lock:
+            for path in set(self.row_of) - set(current):
+                self.rows[self.row_of.pop(path)] = None
+            self.generation += 1
+        changed = [path for path, mtime in current.items() if path not in self.row_of or self.rows[self.row_of[path]][1] != mtime]
+        for start in range(0, len(changed), SEMANTIC_BATCH):
+            if STOP_EVENT.is_set():
+                break
+            batch = changed[start:start + SEMANTIC_BATCH]
+            embeddings = self.model.encode([self.describe(path) for path in batch], batch_size=SEMANTIC_BATCH, normalize_embeddings=True)
+            with self.lock:
+                for path, embedding in zip(batch, embeddings):
+                    row = self.row_of.get(path)
+                    if row is None:
+                        row = self.free_row()
+                        self.row_of[path] = row
+                    self.vectors[row] = embedding.astype(np.float16)
+                    self.rows[row] = [path, current[path]]
+                self.generation += 1
+        with self.lock:
+            self.save()
+
+    # Returns the index of an unused matrix row, growing the matrix file when it is full
+    def free_row(self):
+        if len(self.rows) < self.vectors.shape[0]:
+            self.rows.append(None)
+            return len(self.rows) - 1
+        for i, row in enumerate(self.rows):
+            if row is None:
+                return i
+        capacity = self.vectors.shape[0] * 2
+        self.vectors.flush()
+        del self.vectors
+        with open(self.path, "r+b") as f:
+            f.truncate(capacity * SEMANTIC_DIMENSIONS * 2)
+        self.vectors = np.memmap(self.path, dtype=np.float16, mode="r+", shape=(capacity, SEMANTIC_DIMENSIONS))
+        self.rows.append(None)
+        return len(self.rows) - 1
+
+    def save(self):
+        self.vectors.flush()
+        with open(self.path + ".json", "w") as f:
+            json.dump({"model": SEMANTIC_MODEL, "capacity": self.vectors.shape[0], "rows": self.rows}, f)
+
+    # Returns the text embedded for a path: its name as words, its folder, and the start of its text
+    @staticmethod
+    def describe(path):
+        name = os.path.basename(path)
+        words = re.sub(r"[_\-.]+", " ", name)
+        words = re.sub(r"([a-z])([A-Z])", r"\1 \2", words)
+        text = f"{words} in {os.path.basename(os.path.dirname(path))}"
+        if SEMANTIC_TEXT_BYTES and os.path.splitext(name)[1].lower() in CONTENT_INDEX_EXTENSIONS:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read(SEMANTIC_TEXT_BYTES)
+                if b"\0" not in data:
+                    text += ": " + " ".join(data.decode("utf-8", errors="ignore").split())
+            except OSError:
+                pass
+        return text
+
+    # Returns whether the index holds the files of a folder
+    def covers(self, folder):
+        folder = os.path.realpath(folder)
+        return any(FileIndex.contains(root, folder) for root in self.roots)
+
+    # Returns the (path, cosine similarity) pairs under a folder closest to a description
+    def search(self, description, folder):
+        query = self.model.encode([description], normalize_embeddings=True)[0].astype(np.float32)
+        prefix = os.path.realpath(folder).rstrip(os.sep) + os.sep
+        with self.lock:
+            count = len(self.rows)
+            cached_prefix, generation, mask = self.mask_cache
+            if cached_prefix != prefix or generation != self.generation:
+                mask = np.fromiter((row is not None and row[0].startswith(prefix) for row in self.rows), dtype=bool, count=count)
+                self.mask_cache = (prefix, self.generation, mask)
+            if not mask.any():
+                return []
+            # Vectors are normalized, so the dot product is the cosine similarity
+            # Rows are converted to float32 in cache-sized chunks instead of copying the whole matrix
+            scores = np.empty(count, dtype=np.float32)
+            chunk = np.empty((4096, SEMANTIC_DIMENSIONS), dtype=np.float32)
+            for start in range(0, count, 4096):
+                size = min(4096, count - start)
+                np.copyto(chunk[:size], self.vectors[start:start + size])
+                np.dot(chunk[:size], query, out=scores[start:start + size])
+            scores[~mask] = -np.inf
+            k = min(SEMANTIC_RESULTS, int(mask.sum()))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.rows[i][0], float(scores[i])) for i in top]
+
+SEMANTIC_INDEX = SemanticIndex(get_source_path("semantic_index.f16"))
+
 # Class for managing the conversation memory
 class ConversationMemory:
     def __init__(self, max_messages = 6):
         self.history = []
         self.max_messages = max_messages
+        self.lock = threading.Lock()
 
     # Add a message to the conversation history
     # Automatically rotates history if needed
     def add_message(self, role, content):
-        if role in ["LCO", "LCI"]:
+        if role in ["LCO", "LCI", "JOB"]:
             content = truncate_middle(content, 60)
         elif role in ["USER", "AI"]:
             content = truncate_middle(content, 200)
 
-        self.history.append({"role": role, "content": content})
+        with self.lock:
+            self.history.append({"role": role, "content": content})
 
-        # Rotate history if exceeding maximum messages
-        if len(self.history) > self.max_messages:
-            self.history = self.history[-self.max_messages:]
+            # Rotate history if exceeding maximum messages
+            if len(self.history) > self.max_messages:
+                self.history = self.history[-self.max_messages:]
 
     # Returns the history in proper formatting
     def get_formatted_history(self):
-        if not self.history:
+        with self.lock:
+            history = list(self.history)
+        if not history:
             return "[No previous history]"
-        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in self.history])
+        return "\n".join([f"{msg['role']}: {msg['content']}" for msg in history])
 
 # Dashboard for KiloBuddy
 class KiloBuddyDashboard:
@@ -1726,12 +4980,20 @@ class KiloBuddyDashboard:
 
         self.set_status_lights("waiting")
 
+        self.queue_label = ctk.CTkLabel(status_frame, text="", text_color="#AAAAAA", font=ctk.CTkFont(family=self.stacksans_light_family, size=self.status_font_size))
+        self.queue_label.pack(side="left", padx=(int(10 * WINDOW_SCALING), 0))
+        self.queue_status_job = None
+        self.update_queue_status()
+
         quit_btn = ctk.CTkButton(button_frame, text="Stop KB", command=self.quit_kilobuddy, fg_color="#f44336", hover_color="#d32f2f", font=ctk.CTkFont(family=self.stacksans_light_family, size=self.button_font_size), width=int(100 * WINDOW_SCALING), height=int(35 * WINDOW_SCALING))
         quit_btn.pack(side="right")
 
         settings_btn = ctk.CTkButton(button_frame, text="Settings", command=self.open_settings_window, fg_color="#607d8b", hover_color="#546e7a", font=ctk.CTkFont(family=self.stacksans_light_family, size=self.button_font_size), width=int(120 * WINDOW_SCALING), height=int(35 * WINDOW_SCALING))
         settings_btn.pack(side="right", padx=(0, int(10 * WINDOW_SCALING)))
 
+        cancel_btn = ctk.CTkButton(button_frame, text="Cancel", command=self.cancel_commands, fg_color="#FF9800", hover_color="#F57C00", font=ctk.CTkFont(family=self.stacksans_light_family, size=self.button_font_size), width=int(100 * WINDOW_SCALING), height=int(35 * WINDOW_SCALING))
+        cancel_btn.pack(side="right", padx=(0, int(10 * WINDOW_SCALING)))
+
         output_frame = ctk.CTkFrame(self.root, fg_color=self.frame_color, corner_radius=15)
         output_frame.pack(fill="both", expand=True, padx=int(20 * WINDOW_SCALING), pady=int(10 * WINDOW_SCALING))
 
@@ -2034,25 +5296,43 @@ class KiloBuddyDashboard:
         if command and command.strip():
             self.command_entry.delete(0, "end")
             
+            if COMMAND_QUEUE.submit(command, PRIORITY_TYPED, self.on_command_finished) is None:
+                self.update_output_with_response("The command queue is full. Try again once the current commands finish.")
+                self.set_status_lights("error")
+                return
             self.set_status_lights("processing")
-            self.root.update()
-            
-            import threading
-            thread = threading.Thread(target=self.process_command_async, args=(command,))
-            thread.daemon = True
-            thread.start()
+            self.update_queue_status()
     
-    def process_command_async(self, command):
-        try:
-            process_command(command)
-            
-            self.root.after(0, lambda: self.set_status_lights("complete"))
-            self.root.after(0, self.update_output_with_latest_response)
-            
-        except Exception as e:
-            error_msg = f"Error processing command: {str(e)}"
+    # Stop the running commands and drop the ones still waiting
+    def cancel_commands(self):
+        running = COMMAND_QUEUE.cancel_running()
+        waiting = COMMAND_QUEUE.cancel_pending()
+        if running or waiting:
+            self.update_output_with_response(f"Cancelled {running} running and {waiting} queued command{'s' if running + waiting != 1 else ''}.")
+            self.set_status_lights("error")
+        self.update_queue_status()
+
+    # Called on the command queue worker once a typed command finishes
+    def on_command_finished(self, execution, error):
+        if execution is not None and execution.cancel_token.is_cancelled():
+            return
+        if error is not None:
+            error_msg = f"Error processing command: {str(error)}"
             self.root.after(0, self.update_output_with_response, error_msg)
             self.root.after(0, lambda: self.set_status_lights("error"))
+        else:
+            self.root.after(0, lambda: self.set_status_lights("complete"))
+            self.root.after(0, self.update_output_with_latest_response)
+
+    # Show the command queue depth next to the status lights
+    def update_queue_status(self):
+        try:
+            self.queue_label.configure(text=COMMAND_QUEUE.status_text())
+            if self.queue_status_job is not None:
+                self.root.after_cancel(self.queue_status_job)
+            self.queue_status_job = self.root.after(1000, self.update_queue_status)
+        except tk.TclError:
+            pass
     
     def update_output_with_response(self, text):
         global LAST_OUTPUT
@@ -2169,6 +5449,8 @@ def request_kilobuddy_stop():
 
     STOP_EVENT.set()
     stop_ollama()
+    COMMAND_QUEUE.shutdown()
+    JOBS.cancel_all()
     cleanup_lock_file()
     global audio_stream, VOICE_THREAD
     if VOICE_THREAD is not None and VOICE_THREAD.is_alive():
@@ -2217,8 +5499,17 @@ def show_dashboard():
     # dashboard = KiloBuddyDashboard()
     # dashboard.run()
 
+# Returns the output of a tool step the user declined, or that batch mode declined since it cannot ask
+def declined_message(operation, reason):
+    if HEADLESS:
+        return f"{operation} declined automatically {reason}: batch mode cannot ask for confirmation."
+    return f"{operation} declined by user {reason}."
+
 # Show failure notification popup
 def show_failure_notification(message):
+    # Batch mode has no windows, the error is already in the log
+    if HEADLESS:
+        return
     def show_popup():
         try:
             popup = tk.Tk()
@@ -2277,8 +5568,12 @@ def show_failure_notification(message):
     popup_thread.start()
 
 
+# Batch mode has no one to answer, so it declines right away
 def show_custom_confirm(title, message, parent=None):
     result = {"value": False}
+    if HEADLESS:
+        print(f"INFO: Declined '{title}' automatically in batch mode.")
+        return False
     try:
         dialog = ctk.CTkToplevel(parent) if parent else ctk.CTkToplevel()
         dialog.title(title)
@@ -2464,6 +5759,128 @@ def check_for_updates():
         print(f"ERROR: Failed to check for updates: {e}\nERROR 140")
         return None
 
+# Read batch commands from a file with one command per line or one JSON object per line
+# JSON lines use "command" and optionally "id"; blank lines and lines starting with # are skipped
+# Lines that cannot be read are kept with an error so they show up in the results
+def load_batch_commands(path):
+    commands = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"ERROR: Invalid JSON on line {number} of batch file: {e}\nERROR 167")
+                    commands.append({"id": str(number), "command": line, "error": f"Invalid JSON: {e}"})
+                    continue
+                if not isinstance(entry, dict) or not str(entry.get("command", "")).strip():
+                    print(f"ERROR: Line {number} of batch file has no command.\nERROR 167")
+                    commands.append({"id": str(number), "command": line, "error": "No command"})
+                    continue
+                commands.append({"id": str(entry.get("id", number)), "command": str(entry["command"]).strip()})
+            else:
+                commands.append({"id": str(number), "command": line})
+    return commands
+
+# Run one batch command in its own context and returns its result record
+def run_batch_command(entry):
+    started = time.time()
+    result = {"id": entry["id"], "command": entry["command"]}
+    if "error" in entry:
+        result.update({"status": "invalid", "error": entry["error"], "duration": 0.0})
+        return result
+    try:
+        execution = process_command(entry["command"], ConversationMemory(max_messages=6), isolated=True)
+    except Exception as e:
+        print(f"ERROR: Failed to process command: {e}\nERROR 166")
+        result.update({"status": "error", "error": str(e), "duration": round(time.time() - started, 3)})
+        return result
+
+    failed = [record["step"] for record in execution.step_records if record["state"] != "DONE"]
+    if execution.stop_reason:
+        status = "stopped"
+    elif failed or not execution.step_records:
+        status = "failed"
+    else:
+        status = "completed"
+    result.update({
+        "status": status,
+        "response": execution.last_output,
+        "stop_reason": execution.stop_reason,
+        "failed_steps": failed,
+        "duration": round(time.time() - started, 3),
+        "ai_calls": execution.ai_calls,
+        "tokens": execution.tokens,
+        "steps": execution.step_records
+    })
+    return result
+
+# Run a file of commands without windows, writing one JSON result per command
+# Returns whether every command completed
+def run_batch(path, concurrency=BATCH_CONCURRENCY, output_path=None):
+    global HEADLESS, CONVERSATION_HISTORY
+    HEADLESS = True
+    CONVERSATION_HISTORY = ConversationMemory(max_messages=6)
+    if output_path is None:
+        output_path = os.path.splitext(path)[0] + "_results.jsonl"
+
+    try:
+        commands = load_batch_commands(path)
+    except OSError as e:
+        print(f"ERROR: Failed to read batch file: {e}\nERROR 168")
+        return False
+    if not load_prompt() or not load_initial_prompt():
+        print("FATAL: Failed to properly initialize prompt.\n    -The app will not function and will now stop.\nFATAL 0")
+        return False
+    load_settings()
+    load_os_version()
+    start_ollama()
+    SYSTEM_PROFILE.refresh()
+
+    concurrency = max(1, int(concurrency))
+    print(f"INFO: Running {len(commands)} batch commands with concurrency {concurrency}...")
+    started = time.time()
+    counts = {}
+    pending = queue.Queue()
+    for entry in commands:
+        pending.put(entry)
+    write_lock = threading.Lock()
+
+    with open(output_path, "w", encoding="utf-8") as output:
+        def work():
+            while not STOP_EVENT.is_set():
+                try:
+                    entry = pending.get_nowait()
+                except queue.Empty:
+                    return
+                result = run_batch_command(entry)
+                with write_lock:
+                    output.write(json.dumps(result) + "\n")
+                    output.flush()
+                    counts[result["status"]] = counts.get(result["status"], 0) + 1
+                print(f"INFO: Batch command {result['id']} {result['status']} in {result['duration']:.2f}s")
+
+        workers = [threading.Thread(target=work, daemon=True) for _ in range(min(concurrency, len(commands)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    elapsed = time.time() - started
+    finished = sum(counts.values())
+    throughput = finished / elapsed if elapsed > 0 else 0.0
+    summary = ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) or "nothing run"
+    print(f"INFO: Batch finished {finished} commands in {elapsed:.2f}s ({throughput:.2f} commands/s): {summary}. Results written to {output_path}")
+    stop_ollama()
+    return finished == len(commands) and counts.get("completed", 0) == finished
+
+# Returns whether a spoken command only asks to cancel what is running
+def is_cancel_phrase(command):
+    return re.sub(r"[^a-z ]", "", command.lower()).strip() in CANCEL_PHRASES
+
 # Main Method that controls KiloBuddy
 def handle_signal(signum, frame):
     print(f"\nINFO: Signal {signum} received, stopping KiloBuddy...")
@@ -2486,8 +5903,11 @@ def main():
             if listen_for_wake_word():
                 # Start Listening for Command
                 command = listen_for_command()
-                if command:
-                    process_command(command)
+                if command and is_cancel_phrase(command):
+                    cancelled = COMMAND_QUEUE.cancel_running()
+                    show_overlay(f"Cancelled {cancelled} running task{'s' if cancelled != 1 else ''}." if cancelled else "Nothing to cancel.")
+                elif command:
+                    COMMAND_QUEUE.submit(command, PRIORITY_VOICE)
 
                 print("INFO: Returning to wake word listening...")
     except KeyboardInterrupt:
@@ -2539,6 +5959,16 @@ class LogRedirector:
             os.replace(self.path, self.path + ".old")
 
 if __name__ == "__main__":
+    # Batch mode: KiloBuddy.py --batch commands.txt [--concurrency N] [--output results.jsonl]
+    if "--batch" in sys.argv:
+        import argparse
+        parser = argparse.ArgumentParser(description="Run a file of KiloBuddy commands without the dashboard or voice assistant.")
+        parser.add_argument("--batch", required=True, help="file with one command per line, or JSONL objects with a 'command' field")
+        parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="number of commands run at the same time")
+        parser.add_argument("--output", default=None, help="JSONL file for results (default: <batch file>_results.jsonl)")
+        args = parser.parse_args()
+        sys.exit(0 if run_batch(args.batch, args.concurrency, args.output) else 1)
+
     sys.stdout = LogRedirector(LOG_PATH)
     sys.stderr = LogRedirector(LOG_PATH)
 